@@ -0,0 +1,206 @@
+# +
+"""
+Scaling sweeps of the hot paths, written as json lines:
+
+    python benchmarks/run.py > results.jsonl
+    python benchmarks/run.py --only spd kernel --quick
+
+Every line has the benchmark name, its size parameter, the
+best and median time per operation (seconds) of "repeat"
+repetitions and the commit, torch version and threads,
+thus lines from different commits can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from emeta.spd import SPD
+from emeta.kernel import Gaussian
+from emeta.density import GridKDE, KDR
+from emeta.hist import History
+from emeta.variable import Param
+from emeta.integrate import langevin
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def timeit(func, repeat, number=1):
+    """best and median of repeat x (time of number calls)/number"""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter()-t0)/number)
+    times.sort()
+    return times[0], times[len(times)//2]
+
+
+def record(name, size, best, median, **extra):
+    line = {'bench': name, 'size': size, 'best': best, 'median': median,
+            'commit': COMMIT, 'torch': torch.__version__,
+            'threads': torch.get_num_threads(), 'python': platform.python_version()}
+    line.update(extra)
+    print(json.dumps(line), flush=True)
+
+
+def bench_spd(sizes, repeat):
+    """SPD.append_ against the matrix size"""
+    for n in sizes:
+        x = torch.randn(n+1, 3, dtype=torch.float64)
+        k = (-torch.cdist(x, x)**2).exp()
+        k += 1e-3*torch.eye(n+1, dtype=k.dtype)
+
+        def run():
+            spd = SPD(k[:n, :n].clone(), epsilon=0.)
+            spd.inverse()  # the factorization is lazy, only append_ is timed
+            t0 = time.perf_counter()
+            spd.append_(k[:n, n], k[n, n], epsilon=0.)
+            return time.perf_counter()-t0
+        times = sorted(run() for _ in range(repeat))
+        record('spd.append_', n, times[0], times[len(times)//2])
+
+
+def bench_kernel(sizes, repeat, dim=2):
+    """Gaussian kernel (and its grad) against the number of inducing points"""
+    kern = Gaussian(dim, 0.1)
+    x = torch.randn(1, dim, requires_grad=True)
+    for n in sizes:
+        inducing = torch.randn(n, dim)
+
+        def run():
+            kern(x, inducing).sum().backward()
+        record('kernel.forward_backward', n, *timeit(run, repeat, 10), dim=dim)
+        record('kernel.dot', n, *timeit(lambda: kern.dot(x, inducing), repeat, 10),
+               dim=dim)
+
+
+def bench_density(sizes, repeat, dim=2):
+    """evaluate and update of GridKDE/KDR as deposits grow"""
+    for Density in (GridKDE, KDR):
+        for n in sizes:
+            x = Param(f'density_{Density.__name__}_{n}')
+            x.set(torch.randn(dim))
+            density = Density(x, Gaussian(dim, 0.1))
+            density.update_batch(torch.randn(n, dim))
+
+            def evaluate():
+                x.touch()
+                density().backward()
+
+            def update():
+                density.update(torch.randn(dim))
+            name = Density.__name__
+            deposits = density.inducing.size(0)
+            record(f'{name}.evaluate', n, *timeit(evaluate, repeat, 10),
+                   deposits=deposits)
+            record(f'{name}.update', n, *timeit(update, repeat, 10),
+                   deposits=deposits)
+
+
+def bench_biased(sizes, repeat):
+    """Biased.calculate overhead on top of EMT"""
+    try:
+        from ase.build import bulk
+        from ase.calculators.emt import EMT
+        from emeta.calculator import Biased
+        from emeta.atomic import Coordination, Data
+    except ImportError as err:
+        print(f'# biased skipped: {err}', file=sys.stderr)
+        return
+    for n in sizes:
+        atoms = bulk('Cu', cubic=True).repeat(n)
+        atoms.rattle(0.01, seed=0)
+        cv = Coordination(r0=2.6, cutoff=3.5)
+        density = GridKDE(cv, Gaussian(1, 0.1))
+        # seeded around the initial value, an empty density has no grads
+        with torch.no_grad():
+            value = cv(Data(atoms, cache=False)).view(1, 1)
+        density.update_batch(value + 0.1*torch.randn(20, 1, dtype=value.dtype))
+        bias = 0.01*density
+        biased = Biased(bias, EMT(), logfile=None)
+        emt = EMT()
+
+        def plain():
+            atoms.positions[0, 0] += 1e-4
+            emt.calculate(atoms, ['energy', 'forces'])
+
+        def with_bias():
+            atoms.positions[0, 0] += 1e-4
+            biased.calculate(atoms, ['energy', 'forces'])
+            bias.update()
+        t, m = timeit(plain, repeat, 5)
+        tb, mb = timeit(with_bias, repeat, 5)
+        record('biased.overhead', len(atoms), tb-t, mb-m, plain=m, biased=mb)
+        biased.close()
+
+
+def bench_history(sizes, repeat):
+    """History.evaluate with long histories"""
+    for n in sizes:
+        x = Param(f'history_{n}')
+        x.set(torch.randn(1))
+        history = History(x)
+        history.load_state_dict({'history': torch.randn(n, 1)})
+
+        def run():
+            history.touch()
+            history()
+        record('history.evaluate', n, *timeit(run, repeat, 10))
+
+
+def bench_langevin(sizes, repeat, steps=200):
+    """langevin steps per second against the number of params"""
+    for n in sizes:
+        x = Param(f'langevin_{n}')
+        x.set(torch.randn(n))
+        x.dot_(torch.zeros(n))
+        energy = (x*x)/2  # the integrators differentiate the sum
+        best, median = timeit(lambda: langevin(energy, 0.01, 1., 1., steps),
+                              repeat)
+        record('langevin.step', n, best/steps, median/steps,
+               steps_per_second=steps/median)
+
+
+BENCHES = {'spd': (bench_spd, [100, 200, 400, 800, 1600]),
+           'kernel': (bench_kernel, [10**2, 10**3, 10**4, 10**5]),
+           'density': (bench_density, [10, 100, 1000, 5000]),
+           'biased': (bench_biased, [2, 3, 4]),
+           'history': (bench_history, [10**2, 10**3, 10**4, 10**5]),
+           'langevin': (bench_langevin, [1, 10, 100, 1000])}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--only', nargs='*', choices=list(BENCHES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--quick', action='store_true',
+                        help='only the two smallest sizes')
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args(argv)
+    torch.manual_seed(0)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    for name in args.only or BENCHES:
+        bench, sizes = BENCHES[name]
+        bench(sizes[:2] if args.quick else sizes, args.repeat)
+
+
+COMMIT = commit()
+
+if __name__ == '__main__':
+    main()
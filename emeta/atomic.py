@@ -1,24 +1,115 @@
 # +
-from emeta.variable import Variable
+from emeta.variable import Variable, tick
+from emeta.util import get_dtype
+from emeta.neighbor import NeighborList
+from emeta.fused import mic, pair_vectors, pair_distances
+from math import pi
 import torch
 
 
 class Data:
+    """
+    Positions and cell of atoms. The leaves (leaf_pos, leaf_cell)
+    keep the dtype of the inputs (float64 for atoms) and collect
+    the grads, while variables see pos and cell in "dtype"
+    (default: util.get_dtype(), None for the dtype of the inputs).
+    """
 
-    def __init__(self, atoms):
-        self.pos = torch.from_numpy(atoms.positions)
-        self.pos.requires_grad = True
-        self.cell = torch.from_numpy(atoms.cell.array)
-        self.cell.requires_grad = True
-        self.rcell = self.cell.inverse()
+    def __init__(self, atoms=None, pos=None, cell=None, pbc=None, cache=True,
+                 dtype=None):
+        if atoms is not None:
+            pos = torch.from_numpy(atoms.positions)
+            pos.requires_grad = True
+            cell = torch.from_numpy(atoms.cell.array)
+            cell.requires_grad = True
+            pbc = atoms.pbc
+        self.dtype = dtype or get_dtype()
+        self.leaf_pos = pos
+        self.leaf_cell = cell
+        self.pbc = pbc
+        self.cast()
+        self.values = {}
+        # without a version, variables do not cache values of this data
+        self.version = tick() if cache else None
+        self._inverse = None
+        self._rcell = None
+
+    def cast(self):
+        if self.dtype is None:
+            self.pos, self.cell = self.leaf_pos, self.leaf_cell
+        else:
+            self.pos = self.leaf_pos.to(self.dtype)
+            self.cell = self.leaf_cell.to(self.dtype)
+
+    @property
+    def rcell(self):
+        if self._rcell is None:
+            if self.cell.requires_grad:
+                if self._inverse is None:
+                    # inverted in the dtype of the leaf
+                    self._inverse = self.leaf_cell.detach().inverse().to(
+                        self.cell.dtype)
+                self._rcell = Inverse.apply(self.cell, self._inverse)
+            else:
+                self._rcell = self.cell.inverse()
+        return self._rcell
+
+    def refresh(self, atoms):
+        """
+        Copies positions and cell of atoms in place, keeping the
+        tensors (and their grads, which are zeroed) of this data.
+        The inverse of the cell is reused if the cell is unchanged.
+        """
+        cell = torch.from_numpy(atoms.cell.array)
+        with torch.no_grad():
+            self.leaf_pos.copy_(torch.from_numpy(atoms.positions))
+            if not torch.equal(cell, self.leaf_cell):
+                self.leaf_cell.copy_(cell)
+                self._inverse = None
+        for t in (self.leaf_pos, self.leaf_cell):
+            if t.grad is not None:
+                t.grad.zero_()
         self.pbc = atoms.pbc
+        self.cast()
+        self.values.clear()
+        self.version = tick()
+        self._rcell = None
+
+    # Data is also the evaluation context of atomic variables
+    def __contains__(self, var):
+        return var in self.values
+
+    def __getitem__(self, var):
+        return self.values[var]
+
+    def __setitem__(self, var, value):
+        self.values[var] = value
+
+
+class Inverse(torch.autograd.Function):
+    """matrix inverse with a precomputed value"""
+
+    @staticmethod
+    def forward(ctx, matrix, inverse):
+        ctx.save_for_backward(inverse)
+        return inverse.clone()
+
+    @staticmethod
+    def backward(ctx, grad):
+        inverse, = ctx.saved_tensors
+        return -inverse.T @ grad @ inverse.T, None
 
 
 class Atomic(Variable):
 
+    shared = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+    def evaluate(self, data):
+        return self.eval(data)
+
 
 class Cell(Atomic):
 
@@ -70,8 +161,148 @@ class Mic(Atomic):
         self.vectors = vectors
 
     def eval(self, data):
-        vectors = self.vectors(data)
-        scaled = (vectors @ data.rcell) % 1
-        mic = torch.where(scaled <= 0.5, scaled, scaled-1.)
-        rescaled = mic @ data.cell
-        return rescaled
+        return mic(self.vectors(data), data.cell, data.rcell)
+
+
+class Pairs(Atomic):
+    """
+    Pair vectors between groups a and b (index lists,
+    None for all atoms) within cutoff, found with a
+    neighbor list. If b is None, pairs within a are
+    counted once, otherwise all (a, b) pairs are used.
+    These nodes hold a neighbor list and the groups of a
+    system, thus they are not shared; the groups and the
+    list are renewed if the number of atoms changes.
+    """
+
+    shared = False
+
+    def __init__(self, a=None, b=None, cutoff=5., skin=0.5):
+        super().__init__(a, b, cutoff=cutoff, skin=skin)
+        self.a = a
+        self.b = b
+        self.cutoff = cutoff
+        self.skin = skin
+        self.nl = NeighborList(cutoff, skin)
+        self.index = None
+        self.natoms = None
+
+    def groups(self, natoms):
+        self.natoms = natoms
+        self.nl = NeighborList(self.cutoff, self.skin)
+        a = torch.arange(natoms) if self.a is None else torch.as_tensor(self.a)
+        b = a if self.b is None else torch.as_tensor(self.b)
+        self.index = torch.cat([a, b]).unique()
+        self.in_a = torch.isin(self.index, a)
+        self.in_b = torch.isin(self.index, b)
+        self.na = a.size(0)
+        self.nb = b.size(0)
+
+    def pairs(self, data):
+        if self.index is None or self.natoms != data.pos.size(0):
+            self.groups(data.pos.size(0))
+        builds = self.nl.builds
+        i, j, s = self.nl(data.pos[self.index], data.cell, data.pbc)
+        if self.nl.builds != builds:
+            keep = self.in_a[i] & self.in_b[j]
+            if self.b is None:
+                # first non-zero shift component decides for self-images
+                first = torch.where(s[:, 0] != 0, s[:, 0],
+                                    torch.where(s[:, 1] != 0, s[:, 1], s[:, 2]))
+                keep &= (i < j) | ((i == j) & (first > 0))
+            self._pairs = (self.index[i[keep]], self.index[j[keep]], s[keep])
+        return self._pairs
+
+    def eval(self, data):
+        i, j, s = self.pairs(data)
+        return pair_vectors(data.pos, data.cell, i, j, s)
+
+    def distances(self, data):
+        i, j, s = self.pairs(data)
+        return pair_distances(data.pos, data.cell, i, j, s)
+
+
+class Distance(Pairs):
+
+    def eval(self, data):
+        d = self.distances(data)
+        return d[d < self.cutoff]
+
+
+def rational(r, r0, n=6, m=12):
+    x = r/r0
+    close = (x-1).abs() < 1e-6
+    x = torch.where(close, torch.full_like(x, 0.5), x)
+    s = (1-x.pow(n))/(1-x.pow(m))
+    return torch.where(close, torch.full_like(x, n/m), s)
+
+
+class Coordination(Pairs):
+    """
+    sum of rational switching functions (1-(r/r0)^n)/(1-(r/r0)^m),
+    stretched to vanish at cutoff (default 2*r0).
+    """
+
+    def __init__(self, a=None, b=None, r0=2., n=6, m=12, cutoff=None, skin=0.5):
+        super().__init__(a, b, cutoff=cutoff or 2*r0, skin=skin)
+        self.r0 = r0
+        self.n = n
+        self.m = m
+
+    def eval(self, data):
+        d = self.distances(data)
+        smax = rational(torch.tensor(self.cutoff), self.r0, self.n, self.m)
+        s = (rational(d, self.r0, self.n, self.m) - smax)/(1-smax)
+        return torch.where(d < self.cutoff, s, torch.zeros_like(s)).sum()
+
+
+class RDF(Pairs):
+    """
+    radial distribution function on bins centered at
+    (k+1/2)*rmax/bins, smoothed with gaussians of width sigma.
+    """
+
+    def __init__(self, a=None, b=None, rmax=5., bins=50, sigma=None, skin=0.5):
+        super().__init__(a, b, cutoff=rmax, skin=skin)
+        self.bins = bins
+        delta = rmax/bins
+        self.sigma = sigma or delta
+        self.r = (torch.arange(bins)+0.5)*delta
+
+    def eval(self, data):
+        d = self.distances(data)
+        d = d[d < self.cutoff]
+        r = self.r.to(d.dtype)
+        g = (r[:, None]-d[None]).div(self.sigma).pow(2).div(-2).exp().sum(dim=1)
+        g = g/((2*pi)**0.5*self.sigma)
+        volume = data.cell.det().abs()
+        if self.b is None:
+            pairs = self.na*(self.na-1)/2
+        else:
+            pairs = self.na*self.nb
+        return g*volume/(4*pi*r.pow(2)*pairs)
+
+
+def test_Pairs():
+    torch.manual_seed(0)
+    # the atoms are far from their images, thus the periodic
+    # and the non-periodic cells have the same pairs
+    cell = 20*torch.eye(3, dtype=torch.float64)
+    a = Coordination(r0=1.5, cutoff=3.)
+    b = Coordination(r0=1.5, cutoff=3.)
+    ok = a is not b
+    for pbc in ([False]*3, [True]*3):
+        for natoms in (4, 8):
+            pos = 3*torch.rand(natoms, 3, dtype=torch.float64)
+            d = torch.cdist(pos, pos)
+            d = d[torch.triu_indices(natoms, natoms, 1).unbind()]
+            smax = rational(torch.tensor(3.), 1.5)
+            s = (rational(d, 1.5) - smax)/(1-smax)
+            ref = torch.where(d < 3., s, torch.zeros_like(s)).sum()
+            data = Data(pos=pos, cell=cell, pbc=pbc, cache=False)
+            ok &= bool(a(data).isclose(ref)) and bool(b(data).isclose(ref))
+    print(f'Pairs on systems of different sizes, with and without pbc: {ok}')
+
+
+if __name__ == '__main__':
+    test_Pairs()
@@ -1,23 +1,37 @@
 # +
 from ase.calculators.calculator import Calculator, all_changes
 from emeta.atomic import Data
+from emeta.logger import Writer, read
 import torch
 
 
 class Biased(Calculator):
 
-    def __init__(self, bias, calc, logfile='biased.log'):
+    def __init__(self, bias, calc, logfile='biased.log', compile=False,
+                 binary=False, flush_every=100, flush_interval=5., dtype=None):
         super().__init__()
         self.bias = bias
+        self.dtype = dtype  # of the bias, default: util.get_dtype()
+        self.tape = bias.compile() if compile else None
         self._calc = calc
+        self._data = None
         self.logfile = logfile
-        self.log(f'# bias = {bias}', 'w')
+        if logfile:
+            self.writer = Writer(logfile, every=flush_every,
+                                 interval=flush_interval, binary=binary)
+        else:
+            self.writer = None
+        self.log(f'# bias = {bias}')
         self.log(f'# energy bias')
 
-    def log(self, mssge, mode='a'):
-        if self.logfile:
-            with open(self.logfile, mode) as f:
-                f.write(f'{mssge}\n')
+    def log(self, mssge):
+        if self.writer:
+            self.writer.write(mssge)
+
+    def close(self):
+        """flushes and closes the log"""
+        if self.writer:
+            self.writer.close()
 
     @property
     def implemented_properties(self):
@@ -27,22 +41,29 @@ class Biased(Calculator):
         super().calculate(atoms, properties, system_changes)
         self._calc.calculate(self.atoms)
         self.results = self._calc.results
-        data = Data(self.atoms)
+        if self._data is None or self._data.pos.size(0) != len(self.atoms):
+            self._data = Data(self.atoms, dtype=self.dtype)
+        else:
+            self._data.refresh(self.atoms)
+        data = self._data
 
-        # energy & forces
-        self.bias._backward()
-        e = self.bias(data)
-        self.log('{} {}'.format(self.results['energy'], float(e)))
+        # energy & forces (grads of the float64 leaves)
+        if self.tape is None:
+            e = self.bias(data)
+        else:
+            e = self.tape(data)
+        if self.writer:
+            self.writer.row((self.results['energy'], float(e)))
         e.backward()
-        f = -data.pos.grad.detach().numpy()
+        f = -data.leaf_pos.grad.detach().numpy()
         self.results['energy'] += float(e)
         self.results['forces'] += f
 
         # stress
         if 'stress' in self.results.keys():
             s1 = -(f[:, None]*atoms.positions[..., None]).sum(axis=0)
-            if data.cell.grad is not None:
-                c = data.cell.grad.detach().numpy()
+            if data.leaf_cell.grad is not None:
+                c = data.leaf_cell.grad.detach().numpy()
                 s2 = (c[:, None]*atoms.cell[..., None]).sum(axis=0)
             else:
                 s2 = 0
@@ -55,9 +76,8 @@ class Biased(Calculator):
 
 
 def log_to_fig(file='biased.log'):
-    import numpy as np
     import pylab as plt
-    e, b = np.loadtxt(file, unpack=True)
+    e, b = read(file).T
     fig, axe = plt.subplots(1, 1)
     #
     color = 'blue'
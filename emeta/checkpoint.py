@@ -0,0 +1,91 @@
+# +
+"""
+Binary checkpoints of accumulated state (e.g. densities,
+histograms and their SPD factors). Objects implementing
+state_dict/load_state_dict are saved by name:
+
+    save('bias.ckpt', bias=density)
+    load('bias.ckpt', bias=density)
+
+Tensors are stored as contiguous arrays aligned to 64 bytes
+after a json header, thus they are memory-mapped on load
+(copy-on-write) instead of being read and parsed.
+"""
+import json
+import os
+import numpy as np
+import torch
+
+
+MAGIC = b'EMETACKP'
+ALIGN = 64
+
+
+def aligned(n):
+    return -(-n//ALIGN)*ALIGN
+
+
+def save(file, **objects):
+    arrays, scalars = {}, {}
+    for name, obj in objects.items():
+        for key, val in obj.state_dict().items():
+            if isinstance(val, torch.Tensor):
+                arrays[f'{name}/{key}'] = np.ascontiguousarray(
+                    val.detach().cpu().numpy())
+            else:
+                scalars[f'{name}/{key}'] = val
+    header = {'arrays': {}, 'scalars': scalars}
+    offset = 0
+    for key, arr in arrays.items():
+        header['arrays'][key] = {'dtype': arr.dtype.str, 'shape': arr.shape,
+                                 'offset': offset}
+        offset = aligned(offset + arr.nbytes)
+    head = json.dumps(header).encode()
+    start = aligned(len(MAGIC) + 8 + len(head))
+    # write to a temporary file first, a killed job leaves the old checkpoint
+    tmp = f'{file}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + len(head).to_bytes(8, 'little') + head)
+        for key, arr in arrays.items():
+            f.seek(start + header['arrays'][key]['offset'])
+            f.write(arr.tobytes())
+        f.truncate(start + offset)
+    os.replace(tmp, file)
+
+
+def read(file, mmap=True):
+    with open(file, 'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC, f'{file} is not a checkpoint'
+        size = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(size))
+    start = aligned(len(MAGIC) + 8 + size)
+    if mmap:
+        buffer = np.memmap(file, dtype=np.uint8, mode='c')
+    else:
+        buffer = np.fromfile(file, dtype=np.uint8)
+    arrays = {}
+    for key, meta in header['arrays'].items():
+        dtype = np.dtype(meta['dtype'])
+        count = int(np.prod(meta['shape']))
+        a = start + meta['offset']
+        arr = buffer[a:a+count*dtype.itemsize].view(dtype)
+        arrays[key] = torch.from_numpy(arr.reshape(meta['shape']))
+    return arrays, header['scalars']
+
+
+def load(file, mmap=True, **objects):
+    arrays, scalars = read(file, mmap=mmap)
+    for name, obj in objects.items():
+        prefix = f'{name}/'
+        state = {key[len(prefix):]: val for key, val in
+                 (*arrays.items(), *scalars.items()) if key.startswith(prefix)}
+        obj.load_state_dict(state)
+
+
+def prefixed(prefix, state):
+    return {f'{prefix}.{key}': val for key, val in state.items()}
+
+
+def unprefixed(prefix, state):
+    p = f'{prefix}.'
+    return {key[len(p):]: val for key, val in state.items() if key.startswith(p)}
@@ -1,22 +1,38 @@
 # +
-from .variable import Variable
+from .variable import Variable, Param
 from .spd import SPD
-from collections import Counter
+from .util import Buffer, bin_index
+from .index import Buckets
+from .checkpoint import prefixed, unprefixed
+from .kernel import Gaussian
 import torch
 
 
-def discrete(val, scale):
-    return tuple(val.div(scale).floor().int().view(-1).tolist())
-
-
 class Density(Variable):
+    """
+    Deposits are made every "stride" updates and committed
+    in blocks of "bulk" samples. If tempering is given, the
+    deposits are weighted by exp(-tempering*S(x)) where S is
+    the (unnormalized) kernel sum of previous deposits at x
+    (well-tempered metadynamics with tempering=height/dT).
+    """
 
-    def __init__(self, var, kern, as_hist=False):
+    def __init__(self, var, kern, as_hist=False, table=None, walkers=None,
+                 stride=1, bulk=1, tempering=None):
         super().__init__(var, kern)
         self.requires_update.add(self)
         self.var = var
         self.kern = kern
         self.as_hist = as_hist
+        self.table = table
+        self.walkers = walkers
+        self.stride = stride
+        self.bulk = bulk
+        self.tempering = tempering
+        self.steps = 0
+        self.pending = []
+        self.heights = Buffer()
+        self.index = None
         self.data = []
 
     @property
@@ -28,54 +44,194 @@ class Density(Variable):
 
     @property
     def weights(self):
-        return None
+        if self.tempering is None:
+            return None
+        return self.heights.data
 
     def evaluate(self, context):
-        input = torch.atleast_2d(torch.as_tensor(self.var(context)))
+        input = torch.as_tensor(self.var(context)).reshape(-1, self.kern.dim)
         inducing = self.inducing
         if inducing is None:
             return torch.tensor(0.)
-        kern = self.kern(input, inducing)
-        weights = self.weights.type(kern.type())
+        weights = self.weights
+        kern = self.kernel_sum(input, inducing, weights)
         if weights is None:
             norm = inducing.size(0)
         else:
-            kern = kern@weights
             norm = weights.sum()
         if self.as_hist:
             norm = 1./self.kern.dvol
-        return kern.sum(dim=1)/(self.kern.normalization*norm)
+        return kern/(self.kern.normalization*norm)
+
+    def kernel_sum(self, input, inducing, weights):
+        if self.table is not None and self.table.covers(input):
+            return self.table(input)
+        if getattr(self.kern, 'support', None):
+            idx = self.neighbors(input, inducing)
+            if idx.size(0) == 0:
+                return input.new_zeros(input.size(0))
+            inducing = inducing[idx]
+            if weights is not None:
+                weights = weights[idx]
+        return self.kern.dot(input, inducing, weights)
+
+    def neighbors(self, input, inducing):
+        """indices of inducing points within the support of the kernel"""
+        width = self.kern.support*torch.as_tensor(self.kern.scale()).detach()
+        if (self.index is None or self.index.size > inducing.size(0) or
+                not torch.equal(self.index.width, width)):
+            self.index = Buckets(width)
+        self.index.extend(inducing)
+        return self.index.query(input)
 
     def update(self, value=None):
-        x = value or self.var().clone().detach()
-        self._update(x)
+        self.steps += 1
+        if self.steps % self.stride != 0:
+            return
+        x = self.var().clone().detach() if value is None else value
+        # rows of kernel dim: one for a single sample, or a batch
+        # (e.g. an ensemble of walkers, even of a scalar variable)
+        self.pending.extend(x.reshape(-1, self.kern.dim).unbind(0))
+        if len(self.pending) >= self.bulk:
+            values = torch.stack(self.pending)
+            self.pending = []
+            self.update_batch(values)
 
-    def _update(self, x):
-        self.data.append(x)
+    def update_batch(self, values):
+        """deposits a block of samples (stacked along dim 0) at once"""
+        self._update_batch(values, self.deposit_weights(values))
+        if self.walkers is not None:
+            self.walkers.push(values)
+            if self.walkers.due():
+                new = self.walkers.pull(values[0].numel())
+                if new.size(0) > 0:
+                    new = new.to(values.dtype).view(-1, *values.shape[1:])
+                    self._update_batch(new, self.deposit_weights(new))
+        self.touch()
+
+    def deposit_weights(self, values):
+        """
+        Samples of a block see the deposits before the block and
+        the previous samples of the block, as in sequential deposits
+        (exactly for Density; approximately for GridKDE and KDR,
+        whose previous deposits are binned or regressed).
+        """
+        if self.tempering is None:
+            return None
+        x = values.view(values.size(0), -1)
+        inducing = self.inducing
+        if inducing is None:
+            s = x.new_zeros(x.size(0))
+        else:
+            s = self.kernel_sum(x, inducing, self.weights).to(x.dtype).view(-1)
+        k = self.kern(x, x).to(x.dtype)
+        w = x.new_zeros(x.size(0))
+        for i in range(x.size(0)):
+            w[i] = (-self.tempering*(s[i] + k[i, :i]@w[:i])).exp()
+        return w.view(-1, 1)
+
+    def _update_batch(self, values, weights=None):
+        self.data.extend(values.unbind(0))
+        if weights is not None:
+            self.heights.append(weights)
+        if self.table is not None:
+            self.table.add(self.kern, values.view(values.size(0), -1), weights)
+
+    def _update(self, x, w=None):
+        self._update_batch(x.unsqueeze(0), None if w is None else w.view(1, 1))
+
+    def state_dict(self):
+        # pending samples (stride/bulk) are not deposited yet, but kept
+        state = {'data': torch.stack(self.data) if self.data else None,
+                 'pending': torch.stack(self.pending) if self.pending else None,
+                 'heights': self.heights.data, 'steps': self.steps}
+        if self.table is not None:
+            state.update(prefixed('table', self.table.state_dict()))
+        return state
+
+    def load_state_dict(self, state):
+        data = state['data']
+        self.data = [] if data is None else list(data.unbind(0))
+        pending = state.get('pending')
+        self.pending = [] if pending is None else list(pending.unbind(0))
+        self.heights = Buffer()
+        if state['heights'] is not None:
+            self.heights.append(state['heights'])
+        self.steps = state['steps']
+        self.index = None
+        if self.table is not None:
+            self.table.load_state_dict(unprefixed('table', state))
+        self.touch()
 
 
 class GridKDE(Density):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.count = Counter()
+        self.rows = {}
+        self.centers = Buffer()
+        self.counts = Buffer()
 
     @property
     def inducing(self):
-        return torch.tensor(list(self.count.keys())).add(0.5)*self.kern.scale()
+        return self.centers.data
 
     @property
     def weights(self):
-        return torch.tensor(list(self.count.values())).view(-1, 1)
+        counts = self.counts.data
+        return None if counts is None else counts.view(-1, 1)
+
+    def _update_batch(self, values, weights=None):
+        x = values.view(values.size(0), -1)
+        if weights is None:
+            weights = torch.ones(x.size(0), 1, dtype=x.dtype)
+        scale = torch.as_tensor(self.kern.scale())
+        bins = x.div(scale).floor().long()
+        keys, inverse = bin_index(bins).unique(return_inverse=True)
+        rows = []
+        for i, key in enumerate(keys.tolist()):
+            row = self.rows.get(key)
+            if row is None:
+                row = self.rows[key] = len(self.rows)
+                first = (inverse == i).nonzero()[0]
+                center = (bins[first]+0.5)*scale
+                self.centers.append(center.to(x.dtype))
+                self.counts.append(torch.zeros(1, dtype=x.dtype))
+            rows.append(row)
+        rows = torch.tensor(rows)
+        w = torch.zeros(rows.size(0), 1, dtype=x.dtype).index_add_(
+            0, inverse, weights.to(x.dtype))
+        self.counts.data.index_add_(0, rows, w.view(-1))
+        if self.table is not None:
+            self.table.add(self.kern, self.centers.data[rows], w)
+
+    def _update(self, x, w=None):
+        self._update_batch(x.unsqueeze(0), None if w is None else w.view(1, 1))
 
-    def _update(self, x):
-        self.count[discrete(x, self.kern.scale())] += 1.
+    def state_dict(self):
+        state = super().state_dict()
+        keys = sorted(self.rows, key=self.rows.get)
+        state['keys'] = torch.tensor(keys, dtype=torch.long)
+        state['centers'] = self.centers.data
+        state['counts'] = self.counts.data
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.rows = {key: row for row, key in enumerate(state['keys'].tolist())}
+        self.centers = Buffer()
+        self.counts = Buffer()
+        if state['centers'] is not None:
+            self.centers.append(state['centers'])
+            self.counts.append(state['counts'])
 
 
 class _KDR(Density):
 
-    def __init__(self, var, kern, dirac=None, epsilon=0.1, noise=1e-6, as_hist=False):
-        super().__init__(var, kern, as_hist=as_hist)
+    def __init__(self, var, kern, dirac=None, epsilon=0.1, noise=1e-6, **kwargs):
+        super().__init__(var, kern, **kwargs)
+        # the factor of the kernel matrix needs a definite kernel
+        assert kern.definite, f'{type(kern).__name__} is not positive definite'
         self.epsilon = epsilon
         self.dirac = dirac or self.kern
         self.noise = noise
@@ -84,19 +240,69 @@ class _KDR(Density):
     def weights(self):
         return self._w
 
-    def _update(self, x):
+    def _start(self, x, w):
+        self.data.append(x)
+        self.k = SPD(torch.ones(1, 1)+self.noise, epsilon=self.epsilon)
+        # weights are kept in the dtype of the samples, the factor in float64
+        self._w = torch.ones(1, 1, dtype=x.dtype)*w
+        if self.table is not None:
+            self.table.add(self.kern, x.view(1, -1), self._w)
+
+    def _update_batch(self, values, weights=None):
+        """
+        Weights are updated for all samples against the current
+        factor in one product and novel samples are added with
+        a single block extension of the factor.
+        """
+        if weights is None:
+            weights = torch.ones(values.size(0), 1, dtype=values.dtype)
         if len(self.data) == 0:
-            self.data.append(x)
-            self.k = SPD(torch.ones(1, 1)+self.noise, epsilon=self.epsilon)
-            self._w = torch.ones(1, 1)
+            self._start(values[0], weights[0].view(1, 1))
+            values, weights = values[1:], weights[1:]
+            if values.size(0) == 0:
+                return
+        x = values.view(values.size(0), -1)
+        inducing = self.inducing
+        delta = self.dirac(x, inducing)
+        dw = (self.k.inverse()@(delta.t()@weights).to(self.k.dtype)).to(x.dtype)
+        self._w = self._w + dw
+        if self.table is not None:
+            self.table.add(self.kern, inducing, dw)
+        k = self.kern(x, inducing)
+        block = self.kern(x, x) + self.noise*torch.eye(x.size(0), dtype=x.dtype)
+        idx = self.k.extend_(k.t(), block)
+        self.data.extend(values[idx].unbind(0))
+        self._w = torch.cat([self._w, self._w.new_zeros(idx.size(0), 1)])
+
+    def _update(self, x, w=None):
+        w = 1. if w is None else w.view(1, 1)
+        if len(self.data) == 0:
+            self._start(x, w)
         else:
             delta = self.dirac(x.view(1, -1), self.inducing)
             inv = self.k.inverse()
-            self._w += inv@delta.t()
+            dw = (inv@delta.t().to(inv.dtype)).to(x.dtype)*w
+            self._w += dw
+            if self.table is not None:
+                self.table.add(self.kern, self.inducing, dw)
             k = self.kern(x.view(1, -1), self.inducing)
             if self.k.append_(k, 1+self.noise):
                 self.data.append(x)
-                self._w = torch.cat([self._w, torch.zeros(1, 1)])
+                self._w = torch.cat([self._w, self._w.new_zeros(1, 1)])
+
+    def state_dict(self):
+        state = super().state_dict()
+        if self.data:
+            state.update(prefixed('k', self.k.state_dict()))
+            state['w'] = self._w
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        if self.data:
+            self.k = SPD(epsilon=self.epsilon)
+            self.k.load_state_dict(unprefixed('k', state))
+            self._w = state['w']
 
 
 class KDR(_KDR):
@@ -106,18 +312,63 @@ class KDR(_KDR):
         self.total = 0
 
     def evaluate(self, context):
-        input = torch.atleast_2d(torch.as_tensor(self.var(context)))
+        input = torch.as_tensor(self.var(context)).reshape(-1, self.kern.dim)
         inducing = self.inducing
         if inducing is None:
             return torch.tensor(0.)
-        kern = self.kern(input, inducing)
-        weights = self.weights.type(kern.type())
-        kern = kern@weights
+        kern = self.kernel_sum(input, inducing, self.weights)
         norm = self.total
         if self.as_hist:
             norm = 1./self.dirac.dvol
-        return kern.sum(dim=1)/(self.dirac.normalization*norm)
+        return kern/(self.dirac.normalization*norm)
+
+    def _update(self, x, w=None):
+        super()._update(x, w)
+        self.total += 1 if w is None else float(w)
+
+    def _update_batch(self, values, weights=None):
+        super()._update_batch(values, weights)
+        self.total += values.size(0) if weights is None else float(weights.sum())
+
+    def state_dict(self):
+        state = super().state_dict()
+        state['total'] = self.total
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.total = state['total']
+
+
+def test_tempering():
+    # a block of deposits vs one at a time
+    x = Param('_t')
+    kern = Gaussian(1, 0.5)
+    values = torch.tensor([[0.], [0.1], [1.], [0.2]], dtype=torch.float64)
+    block = Density(x, kern, bulk=4, tempering=0.5)
+    single = Density(x, kern, tempering=0.5)
+    for v in values:
+        block.update(v)
+        single.update(v)
+    ok = torch.allclose(block.heights.data, single.heights.data)
+    print(f'tempered deposits, a block vs one at a time: {ok}')
+
+
+def test_walkers():
+    # a scalar variable with an ensemble of 4 walkers
+    x = Param('_s')
+    kern = Gaussian(1, 0.5)
+    d = Density(x, kern)
+    x.set(torch.tensor([0., 1., 2., 3.], dtype=torch.float64))
+    d.update()
+    ok = d.inducing.shape == (4, 1)
+    x.set(torch.tensor([0., 0.2, 5., -3.], dtype=torch.float64))
+    ref = kern(x().detach().view(-1, 1), d.inducing).sum(dim=1)
+    ref = ref/(kern.normalization*4)
+    ok &= d().shape == (4,) and torch.allclose(d().detach(), ref)
+    print(f'Density of a scalar variable with walkers: {ok}')
+
 
-    def _update(self, x):
-        super()._update(x)
-        self.total += 1
+if __name__ == '__main__':
+    test_tempering()
+    test_walkers()
@@ -0,0 +1,226 @@
+# +
+"""
+Free energy surfaces from biases and biased runs.
+
+Densities (GridKDE, KDR, ...) are evaluated on a grid in
+chunks by overriding their variable in the context:
+
+    grid = Grid(lower, upper, bins)
+    f = bias_fes(density, grid, height=h, gamma=10.)
+
+Biased runs are reweighted with w = exp((V - c(t))/kT)
+(Tiwary & Parrinello, J. Phys. Chem. B 119, 736 (2015)),
+streaming over the logs of the variables (History) and
+of the bias (Biased) in chunks of rows; with block=n the
+errors are estimated from blocks of n frames:
+
+    f, err = reweight('cv.log', 'biased.log', grid, kt, block=10000)
+"""
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import multiprocessing
+import numpy as np
+import torch
+
+
+class Grid:
+    """bins centered regularly between lower and upper"""
+
+    def __init__(self, lower, upper, bins):
+        self.lower = torch.as_tensor(lower, dtype=torch.float64).view(-1)
+        self.upper = torch.as_tensor(upper, dtype=torch.float64).view(-1)
+        self.dim = self.lower.size(0)
+        self.bins = torch.as_tensor(bins).view(-1).expand(self.dim).long()
+        self.delta = (self.upper-self.lower)/self.bins
+        self.centers = [l + (torch.arange(b, dtype=torch.float64)+0.5)*d for l, b, d
+                        in zip(self.lower, self.bins.tolist(), self.delta)]
+        self.shape = tuple(self.bins.tolist())
+        self.strides = torch.tensor([int(np.prod(self.shape[i+1:]))
+                                     for i in range(self.dim)])
+
+    @property
+    def points(self):
+        mesh = torch.meshgrid(*self.centers, indexing='ij')
+        return torch.stack(mesh, dim=-1).view(-1, self.dim)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def index(self, x):
+        """flat bin index of rows of x, -1 if outside"""
+        x = torch.as_tensor(x, dtype=torch.float64).view(-1, self.dim)
+        i = ((x-self.lower)/self.delta).floor().long()
+        inside = ((i >= 0) & (i < self.bins)).all(dim=1)
+        return torch.where(inside, (i*self.strides).sum(dim=1), -1)
+
+
+def evaluate(density, points, chunk=10000, executor=None, processes=None):
+    """
+    Values of density at points (rows), by chunks; the chunks
+    are mapped with executor (e.g. a thread pool) or with a
+    pool of forked processes which inherit the density.
+    """
+    chunks = points.split(chunk)
+    if processes:
+        _forked['density'] = density
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(processes, mp_context=context,
+                                 initializer=torch.set_num_threads,
+                                 initargs=(1,)) as pool:
+            values = list(pool.map(_evaluate_forked, chunks))
+        del _forked['density']
+    elif executor is not None:
+        values = list(executor.map(lambda x: _evaluate(density, x), chunks))
+    else:
+        values = [_evaluate(density, x) for x in chunks]
+    return torch.cat(values)
+
+
+_forked = {}
+
+
+def _evaluate(density, x):
+    inducing = density.inducing
+    with torch.no_grad():
+        if inducing is not None:
+            x = x.to(inducing.dtype)
+        return density({density.var: x}).detach().view(-1)
+
+
+def _evaluate_forked(x):
+    return _evaluate(_forked['density'], x)
+
+
+def bias_fes(density, grid, height=1., gamma=None, **kwargs):
+    """
+    -V (or -gamma/(gamma-1)*V, well-tempered) on the grid for
+    the bias V = height*density, shifted to a minimum of zero.
+    """
+    v = height*evaluate(density, grid.points, **kwargs).double()
+    f = -v if gamma is None else -gamma/(gamma-1)*v
+    return (f - f.min()).view(grid.shape)
+
+
+def histogram_fes(hist, kt=1.):
+    """bins and -kT log p (min at zero) of a hist.Histogram"""
+    x, p = hist.full()
+    f = -kt*p.double().log()
+    return x, f - f.min()
+
+
+def ct(biases, kt, gamma=None):
+    """
+    c(t) for biases (times, grid points) on a grid:
+    kT log(int e^(gamma V/kT(gamma-1)) / int e^(V/kT(gamma-1)));
+    kT log(<e^(V/kT)>) if gamma is None (not tempered).
+    """
+    v = torch.as_tensor(biases, dtype=torch.float64)
+    if gamma is None:
+        n = torch.tensor(v.size(-1), dtype=v.dtype)
+        return kt*(torch.logsumexp(v/kt, dim=-1) - n.log())
+    a = v/(kt*(gamma-1))
+    return kt*(torch.logsumexp(gamma*a, dim=-1) - torch.logsumexp(a, dim=-1))
+
+
+def stream(file, rows=100000):
+    """
+    Rows of a log (see logger) in chunks; binary logs are
+    memory-mapped, text logs are parsed by chunks of lines
+    (comments are skipped, brackets and commas are ignored).
+    """
+    with open(file, 'rb') as f:
+        binary = f.read(6) == b'\x93NUMPY'
+    if binary:
+        data = np.load(file, mmap_mode='r')
+        for a in range(0, data.shape[0], rows):
+            yield np.asarray(data[a:a+rows])
+        return
+    table = str.maketrans('[],', '   ')
+    with open(file) as f:
+        lines = (line.translate(table) for line in f
+                 if line.strip() and not line.startswith('#'))
+        while True:
+            chunk = list(islice(lines, rows))
+            if len(chunk) == 0:
+                break
+            yield np.loadtxt(chunk, ndmin=2)
+
+
+class Reweighting:
+    """
+    Histograms of the variables weighted by exp((V-c)/kT),
+    accumulated in log space (thus without overflows) in
+    total and per block of frames.
+    """
+
+    def __init__(self, grid, kt, block=None):
+        self.grid = grid
+        self.kt = kt
+        self.block = block
+        self.frames = 0
+        self.total = torch.full((grid.size,), -float('inf'), dtype=torch.float64)
+        self.blocks = {}
+
+    def add(self, cv, bias, c=None):
+        cv = torch.as_tensor(np.asarray(cv), dtype=torch.float64)
+        logw = torch.as_tensor(np.asarray(bias), dtype=torch.float64).view(-1)
+        if c is not None:
+            logw = logw - torch.as_tensor(np.asarray(c), dtype=torch.float64).view(-1)
+        logw = logw/self.kt
+        idx = self.grid.index(cv)
+        frames = torch.arange(self.frames, self.frames + idx.size(0))
+        self.frames += idx.size(0)
+        inside = idx >= 0
+        idx, logw, frames = idx[inside], logw[inside], frames[inside]
+        self.total = torch.logaddexp(self.total, self.histogram(idx, logw))
+        if self.block:
+            b = frames // self.block
+            for k in b.unique().tolist():
+                mask = b == k
+                h = self.histogram(idx[mask], logw[mask])
+                if k in self.blocks:
+                    h = torch.logaddexp(self.blocks[k], h)
+                self.blocks[k] = h
+
+    def histogram(self, idx, logw):
+        """log of sum of weights per bin"""
+        out = torch.full((self.grid.size,), -float('inf'), dtype=torch.float64)
+        if idx.size(0) == 0:
+            return out
+        m = logw.max()
+        w = torch.zeros(self.grid.size, dtype=torch.float64).index_add_(
+            0, idx, (logw-m).exp())
+        return torch.where(w > 0, w.log()+m, out)
+
+    def fes(self):
+        """free energy (min at zero) and, with blocks, its error"""
+        f = self.kt*(self.total.max() - self.total)
+        err = None
+        if len(self.blocks) > 1:
+            logp = torch.stack(list(self.blocks.values()))
+            logp = logp - torch.logsumexp(logp, dim=1, keepdim=True)
+            p = logp.exp()
+            mean = p.mean(dim=0)
+            std = p.std(dim=0)/len(self.blocks)**0.5
+            err = self.kt*std/mean
+            err = err.view(self.grid.shape)
+        return f.view(self.grid.shape), err
+
+
+def reweight(cv_file, bias_file, grid, kt, cv_columns=None, bias_column=-1,
+             c=None, block=None, rows=100000):
+    """
+    Streams the logs of the variables (History) and of the bias
+    (Biased, its bias column) and returns fes and errors (if block);
+    c is c(t) per frame (or None) as an array.
+    """
+    rw = Reweighting(grid, kt, block=block)
+    start = 0
+    for cv, bias in zip(stream(cv_file, rows), stream(bias_file, rows)):
+        n = min(cv.shape[0], bias.shape[0])
+        cv = cv[:n] if cv_columns is None else cv[:n, cv_columns]
+        _c = None if c is None else np.asarray(c[start:start+n])
+        rw.add(cv, bias[:n, bias_column], _c)
+        start += n
+    return rw.fes()
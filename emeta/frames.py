@@ -0,0 +1,64 @@
+# +
+"""
+Evaluation of variables over many frames (e.g. a trajectory
+of ase.Atoms) at once, for post-processing. Positions and
+cells of a chunk of frames are stacked with a leading frame
+dimension and the variable is vectorized with torch.func.vmap;
+variables which cannot be vectorized (e.g. with neighbor lists)
+are evaluated frame by frame.
+"""
+from emeta.atomic import Data
+from itertools import islice
+import numpy as np
+import torch
+
+
+def stack(images):
+    pos = torch.from_numpy(np.stack([atoms.positions for atoms in images]))
+    cell = torch.from_numpy(np.stack([atoms.cell.array for atoms in images]))
+    return pos, cell, images[0].pbc
+
+
+def batched(tape, pos, cell, pbc):
+    def func(pos, cell):
+        return tape(Data(pos=pos, cell=cell, pbc=pbc, cache=False))
+    try:
+        return torch.func.vmap(func)(pos, cell)
+    except RuntimeError:
+        return torch.stack([func(p, c) for p, c in zip(pos, cell)])
+
+
+def evaluate(var, images, chunk=1000):
+    """values of var for all images, stacked along dim 0"""
+    tape = var.compile()
+    images = iter(images)
+    values = []
+    with torch.no_grad():
+        while True:
+            block = list(islice(images, chunk))
+            if len(block) == 0:
+                break
+            values.append(batched(tape, *stack(block)))
+    return torch.cat(values)
+
+
+def test_vmap():
+    from emeta.atomic import Pos, Mic
+    torch.manual_seed(0)
+    var = Mic(Pos(1) - Pos(0))
+    tape = var.compile()
+    cell = (4*torch.eye(3) + torch.rand(3, 3)).double().expand(5, 3, 3)
+    pos = 8*torch.rand(5, 3, 3, dtype=torch.float64)
+    pbc = [True]*3
+
+    def func(pos, cell):
+        return tape(Data(pos=pos, cell=cell, pbc=pbc, cache=False))
+    with torch.no_grad():
+        # without the per-frame fallback of batched
+        vmapped = torch.func.vmap(func)(pos, cell)
+        frames = torch.stack([func(p, c) for p, c in zip(pos, cell)])
+    print(f'Mic on the vmap path: {torch.allclose(vmapped, frames)}')
+
+
+if __name__ == '__main__':
+    test_vmap()
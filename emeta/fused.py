@@ -0,0 +1,205 @@
+# +
+"""
+Autograd functions with analytic backward passes for
+common primitives, each of which replaces a graph of
+many small operations by a single node.
+"""
+import torch
+from torch.autograd.function import once_differentiable
+
+
+# Functions are written with a separate setup_context and
+# generate_vmap_rule, thus they work under torch.func.vmap
+# (e.g. frames.batched); tensors needed in backward which are
+# computed in forward are returned as non-differentiable outputs.
+# Backwards which use such tensors (unit vectors, grads of the
+# gaussian sum) are not differentiable again: once_differentiable
+# raises instead of returning wrong second derivatives.
+
+
+class MinimumImage(torch.autograd.Function):
+    """
+    Minimum image of vectors (..., 3) in cell with the inverse
+    rcell (not differentiated): the image is v - n@cell with
+    integer shifts n, thus the grads are grad and -n.T@grad.
+    """
+
+    generate_vmap_rule = True
+
+    @staticmethod
+    def forward(vectors, cell, rcell):
+        scaled = vectors @ rcell
+        frac = scaled % 1
+        shifts = (scaled - torch.where(frac <= 0.5, frac, frac-1.)).round()
+        return vectors - shifts @ cell, shifts
+
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        _, shifts = output
+        ctx.mark_non_differentiable(shifts)
+        ctx.save_for_backward(shifts)
+
+    @staticmethod
+    def backward(ctx, grad, _):
+        shifts, = ctx.saved_tensors
+        grad_cell = None
+        if ctx.needs_input_grad[1]:
+            grad_cell = -shifts.reshape(-1, 3).T @ grad.reshape(-1, 3)
+        return grad, grad_cell, None
+
+
+def mic(vectors, cell, rcell):
+    return MinimumImage.apply(vectors, cell, rcell.detach())[0]
+
+
+class PairVectors(torch.autograd.Function):
+    """r = pos[j] - pos[i] + shifts@cell"""
+
+    generate_vmap_rule = True
+
+    @staticmethod
+    def forward(pos, cell, i, j, shifts):
+        return pos[j] - pos[i] + shifts @ cell
+
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        pos, _, i, j, shifts = inputs
+        ctx.save_for_backward(i, j, shifts)
+        ctx.natoms = pos.size(0)
+
+    @staticmethod
+    def backward(ctx, grad):
+        i, j, shifts = ctx.saved_tensors
+        return (*scatter_pairs(ctx, grad, i, j, shifts), None, None, None)
+
+
+class PairDistances(torch.autograd.Function):
+    """|pos[j] - pos[i] + shifts@cell|"""
+
+    generate_vmap_rule = True
+
+    @staticmethod
+    def forward(pos, cell, i, j, shifts):
+        r = pos[j] - pos[i] + shifts @ cell
+        d = r.norm(dim=1)
+        return d, r/d[:, None]
+
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        pos, _, i, j, shifts = inputs
+        _, unit = output
+        ctx.mark_non_differentiable(unit)
+        ctx.save_for_backward(i, j, shifts, unit)
+        ctx.natoms = pos.size(0)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad, _):
+        i, j, shifts, unit = ctx.saved_tensors
+        g = grad[:, None]*unit
+        return (*scatter_pairs(ctx, g, i, j, shifts), None, None, None)
+
+
+def scatter_pairs(ctx, g, i, j, shifts):
+    """grads of pos and cell from the grads g of pair vectors"""
+    grad_pos = grad_cell = None
+    if ctx.needs_input_grad[0]:
+        grad_pos = g.new_zeros(ctx.natoms, g.size(1)).index_add(
+            0, j, g).index_add(0, i, -g)
+    if ctx.needs_input_grad[1]:
+        grad_cell = shifts.T @ g
+    return grad_pos, grad_cell
+
+
+def pair_vectors(pos, cell, i, j, shifts):
+    return PairVectors.apply(pos, cell, i, j, shifts)
+
+
+def pair_distances(pos, cell, i, j, shifts):
+    return PairDistances.apply(pos, cell, i, j, shifts)[0]
+
+
+class GaussianSum(torch.autograd.Function):
+    """
+    s_i = sum_j w_j exp(-|(x_i-y_j)/scale|^2/2) and (if grad)
+    its grad with respect to x in the same pass; y, scale and
+    the weights w are not differentiated.
+    """
+
+    generate_vmap_rule = True
+
+    @staticmethod
+    def forward(x, y, scale, weights, grad):
+        xs, ys = x/scale, y/scale
+        d = torch.cdist(xs, ys, compute_mode='donot_use_mm_for_euclid_dist')
+        k = d.pow(2).div(-2).exp()
+        if weights is not None:
+            k = k*weights
+        s = k.sum(dim=1)
+        if grad:
+            return s, -(xs*s[:, None] - k@ys)/scale
+        return s, s.new_zeros(0)
+
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        _, dx = output
+        ctx.mark_non_differentiable(dx)
+        ctx.save_for_backward(dx)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad, _):
+        dx, = ctx.saved_tensors
+        return grad[:, None]*dx, None, None, None, None
+
+
+def gaussian_sum(x, y, scale, weights=None):
+    """weights: (m,) or (m, k), summed over columns as in Kernel.dot"""
+    scale = torch.as_tensor(scale, dtype=x.dtype).detach()
+    if weights is not None:
+        weights = weights.detach().to(x.dtype)
+        if weights.dim() > 1:
+            weights = weights.sum(dim=1)
+    grad = x.requires_grad and torch.is_grad_enabled()
+    return GaussianSum.apply(x, y.detach().to(x.dtype), scale, weights, grad)[0]
+
+
+def test_mic():
+    torch.manual_seed(0)
+    cell = (torch.eye(3) + 0.1*torch.rand(3, 3)).double().requires_grad_(True)
+    vectors = (3*torch.randn(5, 3)).double().requires_grad_(True)
+    rcell = cell.detach().inverse()
+    ok = torch.autograd.gradcheck(lambda v, c: mic(v, c, rcell), (vectors, cell))
+    print(f'mic gradcheck: {ok}')
+
+
+def test_pairs():
+    torch.manual_seed(0)
+    pos = torch.randn(6, 3, dtype=torch.float64, requires_grad=True)
+    cell = (3*torch.eye(3)).double().requires_grad_(True)
+    i = torch.tensor([0, 0, 1, 2, 4])
+    j = torch.tensor([1, 2, 3, 5, 4])
+    shifts = torch.tensor([[0, 0, 0], [1, 0, 0], [0, -1, 0],
+                           [0, 0, 1], [1, 1, 0]], dtype=torch.float64)
+    for func in (pair_vectors, pair_distances):
+        ok = torch.autograd.gradcheck(
+            lambda p, c: func(p, c, i, j, shifts), (pos, cell))
+        print(f'{func.__name__} gradcheck: {ok}')
+
+
+def test_gaussian_sum():
+    torch.manual_seed(0)
+    x = torch.randn(4, 2, dtype=torch.float64, requires_grad=True)
+    y = torch.randn(7, 2, dtype=torch.float64)
+    w = torch.rand(7, 1, dtype=torch.float64)
+    scale = torch.tensor([0.5, 0.8], dtype=torch.float64)
+    ok = torch.autograd.gradcheck(lambda x: gaussian_sum(x, y, scale, w), (x,))
+    ref = ((x[:, None]-y[None])/scale).pow(2).sum(dim=-1).div(-2).exp()@w
+    close = torch.allclose(gaussian_sum(x, y, scale, w), ref.view(-1))
+    print(f'gaussian_sum gradcheck: {ok}, close to reference: {close}')
+
+
+if __name__ == '__main__':
+    test_mic()
+    test_pairs()
+    test_gaussian_sum()
@@ -6,12 +6,14 @@ generates a gaussian process regression model for
 f with tuned hyper-params and idealy optimally 
 sampled (X, Y).
 """
+from contextlib import contextmanager
 import torch
 import gpytorch
 
 
 class GPModel(gpytorch.models.ExactGP):
-    def __init__(self, dim, x=None, y=None, mean=None, covar=None, ll=None):
+    def __init__(self, dim, x=None, y=None, mean=None, covar=None, ll=None,
+                 max_steps=None):
         train_x = x or torch.empty(0, dim)
         train_y = y or torch.empty(0)
         likelihood = ll or gpytorch.likelihoods.GaussianLikelihood()
@@ -19,6 +21,8 @@ class GPModel(gpytorch.models.ExactGP):
         self.mean_module = mean or gpytorch.means.ZeroMean()
         self.covar_module = covar or gpytorch.kernels.ScaleKernel(
             gpytorch.kernels.RBFKernel())
+        self.max_steps = max_steps  # optimizer steps per new point
+        self._optimizer = None
         self.eval()
         self.likelihood.eval()
 
@@ -32,36 +36,68 @@ class GPModel(gpytorch.models.ExactGP):
         Y = torch.cat([self.train_targets, y.view(1)])
         self.set_train_data(X, Y, strict=False)
 
-    def build(self, func, inputs, rtol=0.1, train=True):
-        self.sample(func, inputs, rtol=rtol, train=train)
-        self.bootstrap(func, rtol=rtol)
+    def build(self, func, inputs, rtol=0.1, train=True, **kwargs):
+        self.sample(func, inputs, rtol=rtol, train=train, **kwargs)
+        self.bootstrap(func, rtol=rtol, **kwargs)
 
-    def sample(self, func, inputs, rtol=0.1, train=True):
+    def sample(self, func, inputs, rtol=0.1, train=True, parallel=False, **kwargs):
+        if parallel:
+            return self.sample_parallel(func, inputs, rtol=rtol, train=train,
+                                        **kwargs)
         for i in inputs:
             x = self.optimize_inducing(func, i)
             f = func(x).detach()
-            if self.train_inputs[0].size(0) == 0:
-                self.append(x, f)
-            else:
-                m = self(x)
-                delta = (m.mean-f).abs()
-                if delta > rtol*(f+m.variance.sqrt()):
-                    self.append(x, f)
+            self.accept(x, f, rtol=rtol, train=train)
+
+    def sample_parallel(self, func, inputs, rtol=0.1, train=True, batched=False,
+                        executor=None, pool=None):
+        """
+        All inputs are optimized together against the current model
+        (func is called on all rows if batched, else row by row, in
+        executor if given: a thread pool, autograd works across threads).
+        The final values are computed in pool (default: executor, may be
+        a process pool) and accepted sequentially. An empty model has no
+        variance to spread the rows (they would all climb to the same
+        maximum of func), thus it is seeded with the first input.
+        """
+        inputs = torch.stack(list(inputs))
+        if self.train_inputs[0].size(0) == 0 and inputs.size(0) > 1:
+            self.sample_parallel(func, inputs[:1], rtol, train, batched,
+                                 executor, pool)
+            inputs = inputs[1:]
+        xs = self.optimize_inducing_batch(func, inputs, batched=batched,
+                                          executor=executor)
+        fs = rows(func, xs, batched=batched, executor=pool or executor)
+        for x, f in zip(xs, fs.detach()):
+            self.accept(x, f.view(1), rtol=rtol, train=train)
+
+    def accept(self, x, f, rtol=0.1, train=True):
+        if self.train_inputs[0].size(0) == 0:
+            appended = True
+        else:
+            m = self(x)
+            delta = (m.mean-f).abs()
+            appended = delta > rtol*(f+m.variance.sqrt())
+        if appended:
+            self.append(x, f)
             if train:
-                self.optimize_hyperparams()
+                self.optimize_hyperparams(self.max_steps)
 
-    def bootstrap(self, func, rtol=0.1, iterations=2):
+    def bootstrap(self, func, rtol=0.1, iterations=2, **kwargs):
         for _ in range(iterations):
             inputs = self.train_inputs[0]
             self.set_train_data(torch.empty(0, inputs.size(1)),
                                 torch.empty(0), strict=False)
-            self.sample(func, inputs, rtol=rtol, train=False)
+            self.sample(func, inputs, rtol=rtol, train=False, **kwargs)
             self.optimize_hyperparams()
 
     def optimize_hyperparams(self, max_steps=None):
         self.train()
         self.likelihood.train()
-        optimizer = torch.optim.Adam(self.parameters(), lr=0.1)
+        # the optimizer state persists: warm start from the previous optimum
+        if self._optimizer is None:
+            self._optimizer = torch.optim.Adam(self.parameters(), lr=0.1)
+        optimizer = self._optimizer
         mll = gpytorch.mlls.ExactMarginalLogLikelihood(self.likelihood, self)
         _loss = None
         steps = 0
@@ -80,30 +116,150 @@ class GPModel(gpytorch.models.ExactGP):
         self.eval()
         self.likelihood.eval()
 
+    def clear_caches(self):
+        self.prediction_strategy = None
+
+    @contextmanager
+    def frozen(self):
+        """
+        The model as a constant of the inputs: terms cached in
+        eval mode (e.g. inducing matrices) keep no graph, thus
+        they are reused by repeated backward passes.
+        """
+        params = [p for p in self.parameters() if p.requires_grad]
+        for p in params:
+            p.requires_grad_(False)
+        self.clear_caches()
+        try:
+            yield
+        finally:
+            for p in params:
+                p.requires_grad_(True)
+            self.clear_caches()
+
     def optimize_inducing(self, func, i):
         x = i.detach().clone().requires_grad_(True)
         optimizer = torch.optim.Adam([x], lr=0.1)
         _loss = None
-        while True:
+        with self.frozen():
+            while True:
+                optimizer.zero_grad()
+                y = func(x)
+                try:
+                    var = self(x).variance
+                except:
+                    var = torch.ones(1)
+                loss = -y*var
+                loss.backward()
+                optimizer.step()
+                if loss_break(_loss, loss):
+                    break
+                _loss = loss
+        return x.detach()
+
+    def optimize_inducing_batch(self, func, inputs, batched=False, executor=None):
+        with self.frozen():
+            return self._optimize_inducing_batch(func, inputs, batched, executor)
+
+    def _optimize_inducing_batch(self, func, inputs, batched, executor):
+        x = torch.stack(list(inputs)).detach().clone().requires_grad_(True)
+        optimizer = torch.optim.Adam([x], lr=0.1)
+        done = torch.zeros(x.size(0), dtype=torch.bool)
+        _loss = None
+        while not done.all():
             optimizer.zero_grad()
-            y = func(x)
+            y = rows(func, x, batched=batched, executor=executor)
             try:
                 var = self(x).variance
             except:
-                var = torch.ones(1)
+                var = torch.ones(x.size(0))
             loss = -y*var
-            loss.backward()
+            loss.sum().backward()
+            # converged rows are frozen
+            frozen = x.detach()[done].clone()
             optimizer.step()
-            if loss_break(_loss, loss):
-                break
+            with torch.no_grad():
+                x[done] = frozen
+            loss = loss.detach()
+            if _loss is not None:
+                done |= (loss-_loss).abs() < loss.abs()*1e-3
             _loss = loss
         return x.detach()
 
 
+def rows(func, x, batched=False, executor=None):
+    """func of all rows of x as a 1d tensor"""
+    if batched:
+        return func(x).view(-1)
+    if executor is None:
+        return torch.cat([func(r).view(-1) for r in x])
+    return torch.cat([f.view(-1) for f in executor.map(func, x.unbind(0))])
+
+
+class SparseGPModel(GPModel):
+    """
+    SGPR (Titsias) with a bounded set of inducing points,
+    thus training costs O(n m^2) instead of O(n^3). The
+    inducing points are seeded with the first inputs and
+    then optimized along with the hyper-params.
+    """
+
+    def __init__(self, dim, inducing=32, max_steps=50, covar=None, ll=None, **kwargs):
+        likelihood = ll or gpytorch.likelihoods.GaussianLikelihood()
+        base = covar or gpytorch.kernels.ScaleKernel(gpytorch.kernels.RBFKernel())
+        sparse = gpytorch.kernels.InducingPointKernel(
+            base, inducing_points=torch.randn(inducing, dim), likelihood=likelihood)
+        super().__init__(dim, covar=sparse, ll=likelihood, max_steps=max_steps,
+                         **kwargs)
+        self.seeded = 0
+
+    def append(self, x, y):
+        super().append(x, y)
+        z = self.covar_module.inducing_points
+        if self.seeded < z.size(0):
+            with torch.no_grad():
+                z[self.seeded] = x.view(-1)
+            self.seeded += 1
+            self.clear_caches()
+
+    def clear_caches(self):
+        super().clear_caches()
+        self.covar_module.train(False)  # clears cached inducing matrices
+
+
 def loss_break(_loss, loss):
     return _loss is not None and (loss-_loss).abs() < loss.abs()*1e-3
 
 
+def gaussian(x):
+    return x.pow(2).neg().div(4).exp().view(-1)
+
+
+def max_error(model, func):
+    x = torch.linspace(-3, 3, 61).view(-1, 1)
+    with torch.no_grad():
+        return float((model(x).mean - func(x)).abs().max())
+
+
+def test_sparse():
+    torch.manual_seed(0)
+    model = SparseGPModel(1, inducing=8)
+    model.build(gaussian, torch.randn(10, 1))
+    print(f'SparseGPModel: {model.train_inputs[0].size(0)} points, '
+          f'max error {max_error(model, gaussian):.3g}')
+
+
+def test_parallel():
+    inputs = 2*torch.randn(10, 1, generator=torch.Generator().manual_seed(0))
+    errors = []
+    for parallel in (False, True):
+        torch.manual_seed(0)
+        model = GPModel(1)
+        model.build(gaussian, inputs, parallel=parallel)
+        errors.append(max_error(model, gaussian))
+    print('max errors, sequential: {:.3g}, parallel: {:.3g}'.format(*errors))
+
+
 def test():
     import pylab as plt
 
@@ -129,4 +285,6 @@ def test():
 
 
 if __name__ == '__main__':
+    test_sparse()
+    test_parallel()
     test()
@@ -1,6 +1,9 @@
 # +
 from .variable import Variable
 from .spd import SPD
+from .logger import Writer
+from .checkpoint import prefixed, unprefixed
+from .index import Buckets
 from collections import Counter
 from math import pi
 import torch
@@ -20,20 +23,26 @@ def conformed(x):
         return x.view(1, -1)
 
 
-def dist(x, y):
-    _x = conformed(x)
-    _y = conformed(y)
-    return _x[:, None]-_y[None]
+def cdist(x, y):
+    """pairwise euclidean distances without the (n, m, dim) differences"""
+    x, y = conformed(x), conformed(y)
+    dtype = torch.promote_types(x.dtype, y.dtype)
+    return torch.cdist(x.to(dtype), y.to(dtype),
+                       compute_mode='donot_use_mm_for_euclid_dist')
 
 
 class GaussianKernel:
 
-    def __init__(self, delta):
+    def __init__(self, delta, cutoff=None):
         self.delta = torch.as_tensor(delta)
+        self.cutoff = cutoff  # in units of delta, the kernel is shifted to 0
 
     def __call__(self, x, y):
-        d = dist(x, y).div(self.delta).norm(dim=-1)
+        d = cdist(x/self.delta, y/self.delta)
         k = d.pow(2).neg().div(2).exp()
+        if self.cutoff:
+            c = torch.tensor(-self.cutoff**2/2).exp()
+            k = torch.where(d < self.cutoff, (k-c)/(1-c), torch.zeros_like(k))
         return k
 
     def optimize(self, *args, **kwargs):
@@ -56,8 +65,11 @@ class GaussianARD:
         return self.trans(self._param).cholesky_inverse()
 
     def __call__(self, x, y):
-        r = dist(x, y)
-        d = ((r @ self.precision)*r).sum(dim=-1)
+        # r.precision.r = |r.L^-T|^2 for covariance = L.L^T
+        chol = self.trans(self._param)
+        _x = torch.linalg.solve_triangular(chol, conformed(x).T, upper=False).T
+        _y = torch.linalg.solve_triangular(chol, conformed(y).T, upper=False).T
+        d = cdist(_x, _y).pow(2)
         k = d.neg().div(2).exp()
         return k
 
@@ -82,19 +94,24 @@ class GaussianARD:
 
 class History(Variable):
 
-    def __init__(self, var, file=None, stop=float('inf')):
+    def __init__(self, var, file=None, stop=float('inf'), binary=False):
         super().__init__(var, file=file)
         self.requires_update.add(self)
         self.var = var
         self.file = file
+        self.writer = Writer(file, binary=binary) if file else None
         self.history = []
-        self.write(f'# {var}', 'w')
+        self.write(f'# {var}')
         self.stop = stop
 
-    def write(self, msg, mode='a'):
-        if self.file:
-            with open(self.file, mode) as f:
-                f.write(f'{msg}\n')
+    def write(self, msg):
+        if self.writer:
+            self.writer.write(msg)
+
+    def close(self):
+        """flushes and closes the log"""
+        if self.writer:
+            self.writer.close()
 
     def evaluate(self, contex):
         if self.history == []:
@@ -105,7 +122,17 @@ class History(Variable):
         if len(self.history) < self.stop:
             t = x or self.var().clone().detach()
             self.history.append(t)
-            self.write(t.tolist())
+            if self.writer:
+                self.writer.row(t.view(-1).tolist(), line=t.tolist())
+            self.touch()
+
+    def state_dict(self):
+        return {'history': torch.stack(self.history) if self.history else None}
+
+    def load_state_dict(self, state):
+        history = state['history']
+        self.history = [] if history is None else list(history.unbind(0))
+        self.touch()
 
 
 class Histogram(Variable):
@@ -124,6 +151,7 @@ class Histogram(Variable):
     def update(self, x=None):
         if not self.fixed:
             self.hst[discrete(x or self.var(), self.delta)] += 1.
+            self.touch()
 
     def full(self, density=True):
         x = torch.tensor(list(self.hst.keys()))*self.delta
@@ -132,6 +160,15 @@ class Histogram(Variable):
             y /= y.sum()*self.delta.prod()
         return x, y
 
+    def state_dict(self):
+        return {'keys': torch.tensor(list(self.hst.keys())),
+                'counts': torch.tensor(list(self.hst.values()))}
+
+    def load_state_dict(self, state):
+        keys = map(tuple, state['keys'].tolist())
+        self.hst = Counter(dict(zip(keys, state['counts'].tolist())))
+        self.touch()
+
     def save(self, file):
         with open(file, 'w') as f:
             for key, val in self.hst.items():
@@ -170,6 +207,7 @@ class KDR(Variable):
         self.epsilon = epsilon
         self.fixed = False
         self.inducing = []
+        self.index = None
 
     @property
     def X(self):
@@ -177,7 +215,7 @@ class KDR(Variable):
 
     @property
     def y(self):
-        return self.k.data@self.mu / gauss_norm
+        return self.k.data@self.mu.to(self.k.dtype) / gauss_norm
 
     def update(self, x=None):
         if not self.fixed:
@@ -185,16 +223,34 @@ class KDR(Variable):
             if len(self.inducing) == 0:
                 self.inducing.append(x)
                 self.k = SPD(epsilon=self.epsilon)
-                self.mu = torch.ones(1, 1)
+                self.mu = torch.ones(1, 1, dtype=x.dtype)
             else:
                 k = self.kern(x, self.X)
                 inv = self.k.inverse()
-                d_mu = inv@k.t()
-                self.mu += d_mu
+                d_mu = inv@k.t().to(inv.dtype)
+                self.mu += d_mu.to(self.mu.dtype)
                 if self.k.append_(k, 1.):
                     self.inducing.append(x)
                     #self.mu = torch.cat([self.mu, self().detach().view(1, 1)])
-                    self.mu = torch.cat([self.mu, torch.zeros(1, 1)])
+                    self.mu = torch.cat([self.mu, self.mu.new_zeros(1, 1)])
+            self.touch()
+
+    def state_dict(self):
+        if len(self.inducing) == 0:
+            return {'inducing': None}
+        state = {'inducing': self.X, 'mu': self.mu}
+        state.update(prefixed('k', self.k.state_dict()))
+        return state
+
+    def load_state_dict(self, state):
+        inducing = state['inducing']
+        self.inducing = [] if inducing is None else list(inducing.unbind(0))
+        self.index = None
+        if inducing is not None:
+            self.k = SPD(epsilon=self.epsilon)
+            self.k.load_state_dict(unprefixed('k', state))
+            self.mu = state['mu']
+        self.touch()
 
     def optimize(self, **kwargs):
         opt = self.kern.optimize(self.X, self.y, **kwargs)
@@ -205,6 +261,14 @@ class KDR(Variable):
         if len(self.inducing) == 0:
             return torch.zeros(1)
         x = self.var(context)
-        k = self.kern(x, self.X)
-        kde = (k@self.mu).sum(dim=-1)
+        X, mu = self.X, self.mu
+        if getattr(self.kern, 'cutoff', None):
+            width = self.kern.cutoff*self.kern.delta
+            if self.index is None or self.index.size > X.size(0):
+                self.index = Buckets(width)
+            self.index.extend(X)
+            idx = self.index.query(conformed(x))
+            X, mu = X[idx], mu[idx]
+        k = self.kern(x, X)
+        kde = (k@mu).sum(dim=-1)
         return kde / gauss_norm
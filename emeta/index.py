@@ -0,0 +1,36 @@
+# +
+from .util import bin_index
+import itertools
+import torch
+
+
+class Buckets:
+    """
+    Uniform grid of buckets (of the given width) over the
+    rows of a growing tensor of points; a query returns the
+    indices of all points in the buckets adjacent to those
+    of the inputs, which include all points within width.
+    """
+
+    def __init__(self, width):
+        self.width = torch.as_tensor(width)
+        self.buckets = {}
+        self.size = 0
+
+    def extend(self, points):
+        """indexes the rows of points added since the last call"""
+        new = points[self.size:].detach()
+        if new.size(0) == 0:
+            return
+        keys = bin_index(new.div(self.width).floor().long())
+        for i, key in enumerate(keys.tolist(), start=self.size):
+            self.buckets.setdefault(key, []).append(i)
+        self.size = points.size(0)
+
+    def query(self, x):
+        bins = x.detach().div(self.width).floor().long()
+        dim = bins.size(1)
+        offsets = torch.tensor(list(itertools.product([-1, 0, 1], repeat=dim)))
+        keys = bin_index((bins[:, None]+offsets).view(-1, dim)).unique()
+        idx = [i for key in keys.tolist() for i in self.buckets.get(key, ())]
+        return torch.tensor(idx, dtype=torch.long)
@@ -1,74 +1,347 @@
 # +
+"""
+Trajectories are written as text lines or (binary=True)
+as rows of float64 after a json header which lists the
+columns (energy, params and their velocities) with their
+shapes and offsets in a row. Rows are buffered in a
+preallocated chunk of "every" rows. Binary trajectories
+are memory-mapped by read, which returns column views.
+"""
+import json
+import os
+import numpy as np
 import torch
+from .checkpoint import aligned
+from .variable import Param
+
+
+MAGIC = b'EMETATRJ'
 
 
 class Traj:
 
-    def __init__(self, file=None, mode='w'):
+    def __init__(self, file=None, mode='w', binary=False, every=1000):
+        self.binary = binary
+        self.every = every
+        self.mode = mode
+        self.columns = None
+        self.chunk = None
+        self.rows = 0
         if file:
-            self.file = open(file, mode)
+            if binary:
+                append = mode == 'a' and os.path.exists(file)
+                self.file = open(file, 'r+b' if append else 'wb')
+            else:
+                self.file = open(file, mode)
         else:
             self.file = None
 
     def write(self, *args, **kwargs):
-        if self.file:
+        if self.file and not self.binary:
             self.file.write(*args, **kwargs)
 
+    def header(self, params, walkers=None):
+        """
+        columns: energy, the params and then their velocities
+        (with a leading dim of walkers, if given).
+        """
+        if not self.binary:
+            self.write('# energy ')
+            for x in params:
+                self.write(f'{x.name} {x.name}_dot ')
+            self.write('\n')
+            return
+        shapes = [('energy', [walkers] if walkers else [])]
+        shapes += [(x.name, list(x.data.shape)) for x in params]
+        shapes += [(f'{x.name}_dot', list(x.data.shape)) for x in params]
+        columns, offset = {}, 0
+        for name, shape in shapes:
+            columns[name] = {'shape': shape, 'offset': offset}
+            offset += int(np.prod(shape))
+        self.columns = columns
+        self.chunk = np.empty((self.every, offset))
+        if self.file is None:
+            return
+        self.file.seek(0, 2)
+        if self.file.tell() > 0:
+            head, _ = read_header(self.file)
+            assert head['columns'] == columns, 'columns do not match'
+            return
+        head = json.dumps({'columns': columns, 'cols': offset}).encode()
+        self.file.write(MAGIC + len(head).to_bytes(8, 'little') + head)
+        self.file.truncate(aligned(len(MAGIC) + 8 + len(head)))
+
+    def frame(self, energy, params, x=None, v=None):
+        """
+        x and v are the flat data and velocities of params,
+        if given (e.g. by Flat), they are not concatenated again;
+        flat data of walkers are ordered by walker, not by column.
+        """
+        if self.file is None:
+            return
+        if not self.binary:
+            self.write(f'{energy().data} ')
+            for p in params:
+                self.write(f'{p().data} {p.dot} ')
+            self.write('\n')
+            return
+        if x is None or x.dim() > 1:
+            x = torch.cat([p.data.detach().reshape(-1) for p in params])
+            v = torch.cat([torch.as_tensor(p.dot).reshape(-1) for p in params])
+        row = self.chunk[self.rows]
+        e = energy().detach().reshape(-1)
+        m, n = e.numel(), x.numel()
+        row[:m] = e.cpu().numpy()
+        row[m:m+n] = x.detach().reshape(-1).cpu().numpy()
+        row[m+n:] = v.detach().reshape(-1).cpu().numpy()
+        self.rows += 1
+        if self.rows == self.every:
+            self.flush()
+
+    def flush(self):
+        if self.binary and self.file and self.rows > 0:
+            self.file.seek(0, 2)
+            self.file.write(self.chunk[:self.rows].tobytes())
+            self.file.flush()
+            self.rows = 0
+
     def close(self):
         if self.file:
+            self.flush()
             self.file.close()
 
 
-def verlet(energy, dt, steps, file=None, mode='w'):
-    traj = Traj(file, mode)
-    traj.write('# energy ')
-    for x in energy.params:
-        traj.write(f'{x.name} {x.name}_dot ')
-    traj.write('\n')
+def read_header(f):
+    f.seek(0)
+    assert f.read(len(MAGIC)) == MAGIC, 'not a binary trajectory'
+    size = int.from_bytes(f.read(8), 'little')
+    head = json.loads(f.read(size))
+    return head, aligned(len(MAGIC) + 8 + size)
+
+
+def read(file, mmap=True, tensors=False):
+    """
+    Columns of a binary trajectory as arrays with a leading
+    dim of frames; these are views of the mapped file.
+    """
+    with open(file, 'rb') as f:
+        head, start = read_header(f)
+    cols = head['cols']
+    rows = (os.path.getsize(file) - start)//(8*cols)
+    if rows == 0:
+        # a header without frames: numpy cannot map 0 bytes
+        table = np.empty((0, cols))
+    elif mmap:
+        table = np.memmap(file, dtype='<f8', mode='r', offset=start,
+                          shape=(rows, cols))
+    else:
+        table = np.fromfile(file, dtype='<f8', offset=start,
+                            count=rows*cols).reshape(rows, cols)
+    columns = {}
+    for name, meta in head['columns'].items():
+        a = meta['offset']
+        n = int(np.prod(meta['shape']))
+        col = table[:, a:a+n].reshape(rows, *meta['shape'])
+        columns[name] = torch.from_numpy(col) if tensors else col
+    return columns
+
+
+class Flat:
+    """
+    The data and velocities of params packed in contiguous
+    flat tensors; the params see views of the flat data,
+    thus a half-step is a single vectorized operation.
+    Par data are restored (as leaves) by close.
+
+    With walkers=K, the flat tensors are (K, n) and params
+    get a leading dim of walkers (unless they already have
+    one from a previous run, see Par.walkers) which they
+    keep after close.
+    """
+
+    def __init__(self, params, walkers=None):
+        self.params = list(params)
+        self.walkers = walkers
+        self.lead = (walkers,) if walkers else ()
+        data, dots = [], []
+        for x in self.params:
+            d, v = x.data.detach(), torch.as_tensor(x.dot)
+            if walkers and x.walkers != walkers:
+                d = d.expand(walkers, *d.shape)
+                v = v.expand(walkers, *v.shape)
+            data.append(d)
+            dots.append(v)
+        self.shapes = [d.shape[len(self.lead):] for d in data]
+        self.dtypes = [d.dtype for d in data]
+        self.sizes = [int(torch.tensor(s).prod()) for s in self.shapes]
+        self.x = torch.cat([d.reshape(*self.lead, -1) for d in data],
+                           dim=-1).requires_grad_(True)
+        self.v = torch.cat([v.reshape(*self.lead, -1).to(self.x.dtype)
+                            for v in dots], dim=-1)
+        for x, d, v in zip(self.params, self.split(self.x), self.split(self.v)):
+            x.data = d
+            x.dot_(v)
+        self.touch()
+
+    def split(self, flat):
+        return [f.view(self.lead + tuple(s)) for f, s in
+                zip(flat.split(self.sizes, dim=-1), self.shapes)]
+
+    def touch(self):
+        for x in self.params:
+            x.touch()
+
+    def forces(self, energy):
+        # walkers are independent: the grad of the sum is per walker
+        self.x.grad = None
+        energy().sum().backward()
+        return -self.x.grad
+
+    def close(self):
+        grad = self.x.grad
+        grads = self.split(grad) if grad is not None else [None]*len(self.params)
+        for x, d, v, g, t in zip(self.params, self.split(self.x.detach()),
+                                 self.split(self.v), grads, self.dtypes):
+            x.set(d.clone().to(t))
+            if g is not None:
+                x.data.grad = g.clone().to(t)
+            x.dot_(v.clone())
+            x.walkers = self.walkers
+
+
+def compiled(func, compile):
+    """compile=True: torch.compile, 'script': TorchScript"""
+    if compile == 'script':
+        return torch.jit.script(func)
+    if compile:
+        return torch.compile(func)
+    return func
+
+
+def _verlet_drift(x, v, f, dt: float):
+    x += (v + dt*f/2)*dt
+
+
+def _verlet_kick(v, f, _f, dt: float):
+    v += dt*(_f+f)/2
+
+
+def _kick_drift(x, v, f, dt: float):
+    v += dt*f/2
+    x += dt*v/2
+
+
+def _thermostat_drift(x, v, noise, alpha: float, beta: float, dt: float):
+    v.mul_(alpha).add_(beta*noise)
+    x += dt*v/2
+
+
+def _kick(v, f, dt: float):
+    v += dt*f/2
+
+
+class Noise:
+    """standard normal noise like v, a stream per walker"""
+
+    def __init__(self, v, walkers=None, seed=None):
+        self.v = v
+        self.generators = None
+        if walkers:
+            self.generators = [torch.Generator() for _ in range(walkers)]
+            for k, g in enumerate(self.generators):
+                if seed is None:
+                    g.seed()
+                else:
+                    g.manual_seed(seed+k)
+        elif seed is not None:
+            torch.manual_seed(seed)
+
+    def __call__(self):
+        if self.generators is None:
+            return torch.randn_like(self.v)
+        n, dtype = self.v.size(-1), self.v.dtype
+        return torch.stack([torch.randn(n, generator=g, dtype=dtype)
+                            for g in self.generators])
+
+
+def verlet(energy, dt, steps, file=None, mode='w', compile=False,
+           binary=False):
+    traj = Traj(file, mode, binary=binary)
+    flat = Flat(energy.params)
+    traj.header(flat.params)
+    drift = compiled(_verlet_drift, compile)
+    kick = compiled(_verlet_kick, compile)
+    x, v = flat.x.data, flat.v
     try:
-        energy().backward()
-    except:
-        pass
-    for _ in range(steps):
-        for x in energy.params:
-            x._force = x.force
-            x.add((x.dot + dt*x.force/2)*dt)
-        energy().backward()
-        traj.write(f'{energy().data} ')
-        for x in energy.params:
-            x._dot(dt*(x._force+x.force)/2)
-            traj.write(f'{x().data} {x.dot} ')
-        traj.write('\n')
-        energy.update()
-    traj.close()
-
-
-def langevin(energy, dt, f, kt, steps, file=None, mode='w'):
+        try:
+            f = flat.forces(energy)
+        except:
+            f = torch.zeros_like(x)
+        for _ in range(steps):
+            drift(x, v, f, dt)
+            flat.touch()
+            _f, f = f, flat.forces(energy)
+            kick(v, f, _f, dt)
+            traj.frame(energy, flat.params, x, v)
+            energy.update()
+    finally:
+        flat.close()
+        traj.close()
+
+
+def langevin(energy, dt, f, kt, steps, file=None, mode='w', compile=False,
+             binary=False, walkers=None, seed=None):
+    """
+    walkers=K: an ensemble of K independent walkers, each with
+    its own random stream (seeded by seed+k, if seed is given);
+    energy should evaluate to a tensor of K energies.
+    """
     # J. Chem. Phys. 138, 174102 (2013)
-    traj = Traj(file, mode)
-    traj.write('# energy ')
-    for x in energy.params:
-        traj.write(f'{x.name} {x.name}_dot ')
-    traj.write('\n')
-    alpha = torch.tensor(-f*dt).exp()
-    beta = (1-alpha**2).sqrt()*torch.tensor(kt).sqrt()
+    traj = Traj(file, mode, binary=binary)
+    flat = Flat(energy.params, walkers=walkers)
+    traj.header(flat.params, walkers=walkers)
+    noise = Noise(flat.v, walkers, seed)
+    alpha = float(torch.tensor(-f*dt).exp())
+    beta = float((1-torch.tensor(alpha)**2).sqrt()*torch.tensor(kt).sqrt())
+    kick_drift = compiled(_kick_drift, compile)
+    thermostat_drift = compiled(_thermostat_drift, compile)
+    kick = compiled(_kick, compile)
+    x, v = flat.x.data, flat.v
     try:
-        energy().backward()
-    except:
-        pass
-    for _ in range(steps):
-        for x in energy.params:
-            x._dot(dt*x.force/2)
-            x.add(dt*x.dot/2)
-        energy().backward()
-        for x in energy.params:
-            x.dot_(x.dot*alpha + beta*torch.randn(x.dot.shape))
-            x.add(dt*x.dot/2)
-        energy().backward()
-        traj.write(f'{energy().data} ')
-        for x in energy.params:
-            x._dot(dt*x.force/2)
-            traj.write(f'{x().data} {x.dot} ')
-        traj.write('\n')
-        energy.update()
-    traj.close()
+        try:
+            force = flat.forces(energy)
+        except:
+            force = torch.zeros_like(x)
+        for _ in range(steps):
+            # B A O A B: forces are needed only after the second drift
+            kick_drift(x, v, force, dt)
+            thermostat_drift(x, v, noise(), alpha, beta, dt)
+            flat.touch()
+            force = flat.forces(energy)
+            kick(v, force, dt)
+            traj.frame(energy, flat.params, x, v)
+            energy.update()
+    finally:
+        flat.close()
+        traj.close()
+
+
+def test_integrators():
+    x, y = Param('_x'), Param('_y')
+    x.set(torch.tensor(1., dtype=torch.float64))
+    y.set(torch.tensor([0., 1., -1.], dtype=torch.float64))
+    for p in (x, y):
+        p.dot_(torch.zeros_like(p.data.detach()))
+    energy = x*x/2 + (y*y).sum()/2
+    verlet(energy, 0.01, 100)
+    e = float(energy()) + float(x.dot**2/2 + (y.dot**2).sum()/2)
+    ok = x.data.shape == () and y.data.shape == (3,) and abs(e-1.5) < 1e-3
+    print(f'verlet with a scalar and a vector param: {ok}')
+    energy = x*x/2
+    langevin(energy, 0.01, 1., 1., 10, walkers=3, seed=0)
+    ok = x.data.shape == (3,) and x.walkers == 3
+    print(f'langevin with a scalar param and walkers: {ok}')
+
+
+if __name__ == '__main__':
+    test_integrators()
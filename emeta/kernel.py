@@ -1,10 +1,14 @@
 # +
-from math import pi
+from math import pi, exp, gamma
+from .fused import gaussian_sum
 import torch
 
 
 class Kernel:
 
+    budget = 2**24  # max elements of a kernel chunk in dot
+    definite = True  # positive definite, e.g. for the factor of KDR
+
     def __init__(self, dim):
         self.dim = dim
 
@@ -16,6 +20,17 @@ class Kernel:
     def evaluate(self, x, y):
         raise NotImplementedError('implement in a subclass')
 
+    def dot(self, x, y, weights=None):
+        """sum_j k(x_i, y_j)*weights_j, streamed over chunks of y"""
+        step = max(1, self.budget//max(1, x.size(0)))
+        out = 0
+        for a in range(0, y.size(0), step):
+            k = self(x, y[a:a+step])
+            if weights is not None:
+                k = k@weights[a:a+step]
+            out = out + k.sum(dim=1)
+        return out
+
 
 class Stationary(Kernel):
 
@@ -45,7 +60,14 @@ class Distance(Stationary):
         self.norm = norm
 
     def evaluate(self, x, y):
-        return super().evaluate(x, y).norm(self.norm, dim=2)
+        # pairwise distances without the (n, m, dim) differences
+        p = 2. if self.norm in (None, 'fro') else float(self.norm)
+        scale = self.scale()
+        # cdist does not promote, e.g. float32 table nodes and float64 deposits
+        dtype = torch.promote_types(x.dtype, y.dtype)
+        x, y = x.to(dtype), y.to(dtype)
+        return torch.cdist(x/scale, y/scale, p=p,
+                           compute_mode='donot_use_mm_for_euclid_dist')
 
 
 class Gaussian(Distance):
@@ -56,11 +78,103 @@ class Gaussian(Distance):
     def evaluate(self, x, y):
         return super().evaluate(x, y).pow(2).div(2).neg().exp()
 
+    def dot(self, x, y, weights=None):
+        scale = self.scale()
+        if (self.norm not in (None, 'fro') or y.requires_grad or
+                getattr(scale, 'requires_grad', False) or
+                (weights is not None and weights.requires_grad)):
+            return super().dot(x, y, weights)
+        assert x.dim() == 2 and y.dim() == 2
+        assert x.size(1) == self.dim and y.size(1) == self.dim
+        # the sum and its grad in a single node
+        step = max(1, self.budget//max(1, x.size(0)))
+        out = 0
+        for a in range(0, y.size(0), step):
+            w = None if weights is None else weights[a:a+step]
+            out = out + gaussian_sum(x, y[a:a+step], scale, w)
+        return out
+
     @property
     def normalization(self):
         return torch.tensor(2*pi).pow(self.dim).sqrt()*self.dvol
 
 
+class Truncated(Gaussian):
+    """
+    gaussian shifted to vanish at cutoff (in units of scale);
+    not positive definite, thus not valid for KDR.
+    """
+
+    definite = False
+
+    def __init__(self, dim, scale=1., cutoff=3., norm=None):
+        super().__init__(dim, scale=scale, norm=norm)
+        self.support = cutoff
+
+    dot = Kernel.dot  # not a plain gaussian sum
+
+    def evaluate(self, x, y):
+        d = Distance.evaluate(self, x, y)
+        c = exp(-self.support**2/2)
+        k = (d.pow(2).div(2).neg().exp()-c)/(1-c)
+        return torch.where(d < self.support, k, torch.zeros_like(k))
+
+    @property
+    def normalization(self):
+        d, r = self.dim, self.support
+        inner = (2*pi)**(d/2)*torch.special.gammainc(torch.tensor(d/2),
+                                                     torch.tensor(r**2/2))
+        ball = pi**(d/2)/gamma(d/2+1)*r**d
+        c = exp(-r**2/2)
+        return (inner - c*ball)/(1-c)*self.dvol
+
+
+class Compact(Distance):
+    """radial kernels phi(r) which vanish for r=distance/scale > 1"""
+
+    support = 1.
+
+    def __init__(self, dim, scale=1., norm=None):
+        super().__init__(dim, scale=scale, norm=norm)
+
+    def evaluate(self, x, y):
+        r = super().evaluate(x, y).clamp(max=1.)
+        return self.phi(r)
+
+    @property
+    def normalization(self):
+        # surface of the unit sphere times the radial integral
+        d = self.dim
+        surface = 2*pi**(d/2)/gamma(d/2)
+        return torch.tensor(surface*self.radial(d))*self.dvol
+
+
+class Wendland(Compact):
+    """(1-r)^4 (4r+1), C2 and positive definite for dim <= 3"""
+
+    @property
+    def definite(self):
+        return self.dim <= 3
+
+    def phi(self, r):
+        return (1-r).pow(4)*(4*r+1)
+
+    def radial(self, d):
+        return 1/d - 10/(d+2) + 20/(d+3) - 15/(d+4) + 4/(d+5)
+
+
+class Epanechnikov(Compact):
+    """1-r^2, not positive definite"""
+
+    definite = False
+
+    def phi(self, r):
+        return 1-r.pow(2)
+
+    def radial(self, d):
+        return 2/(d*(d+2))
+
+
 def test_Gaussian():
     delta = 0.2
     inf = 10*delta
@@ -0,0 +1,153 @@
+# +
+"""
+Buffered log files: rows are kept in memory and written
+by a background thread every "every" rows or "interval"
+seconds, and on close/exit. Rows are written as text lines
+or (binary=True) appended to a .npy file of float64 whose
+header is updated at each flush; comment lines of binary
+logs go to a sidecar text file (file + '.txt').
+The file and the thread belong to a sink which is closed
+(flushed) by close, when the writer is garbage collected
+or at exit, whichever comes first.
+"""
+import os
+import threading
+import weakref
+import numpy as np
+
+
+HEADER = 128  # fixed size of .npy headers, thus they can be rewritten
+
+
+def npy_header(rows, cols):
+    magic = np.lib.format.magic(1, 0)
+    header = "{'descr': '<f8', 'fortran_order': False, 'shape': (%d, %d), }" % (
+        rows, cols)
+    header = header.ljust(HEADER - len(magic) - 3) + '\n'
+    return magic + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+
+def read(file, mmap_mode='r'):
+    """reads a text or binary log as an array of rows"""
+    with open(file, 'rb') as f:
+        binary = f.read(6) == b'\x93NUMPY'
+    if binary:
+        return np.load(file, mmap_mode=mmap_mode)
+    return np.loadtxt(file, ndmin=2)
+
+
+class Writer:
+
+    def __init__(self, file, mode='w', every=100, interval=5., binary=False):
+        self.file = file
+        self.sink = _Sink(file, mode, every, interval, binary)
+        # the thread refers to the sink only, thus the writer can be collected
+        self._finalizer = weakref.finalize(self, self.sink.close)
+
+    @property
+    def closed(self):
+        return self.sink.closed
+
+    def write(self, line):
+        self.sink.write(line)
+
+    def row(self, values, line=None):
+        self.sink.row(values, line)
+
+    def flush(self):
+        self.sink.flush()
+
+    def close(self):
+        self._finalizer()
+
+
+class _Sink:
+
+    def __init__(self, file, mode, every, interval, binary):
+        self.file = file
+        self.binary = binary
+        self.every = every
+        self.interval = interval
+        self.rows = 0
+        self.cols = None
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.io_lock = threading.Lock()
+        if binary:
+            if mode == 'a' and os.path.exists(file):
+                self.f = open(file, 'r+b')
+                np.lib.format.read_magic(self.f)
+                shape, _, _ = np.lib.format.read_array_header_1_0(self.f)
+                self.rows, self.cols = shape
+            else:
+                self.f = open(file, 'wb')
+                self.f.write(npy_header(0, 0))
+            self.comments = open(f'{file}.txt', mode)
+        else:
+            self.f = open(file, mode)
+        self.closed = False
+        self.event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, line):
+        with self.lock:
+            self.buffer.append(line)
+
+    def row(self, values, line=None):
+        if not self.binary:
+            values = line if line is not None else ' '.join(
+                str(v) for v in values)
+        with self.lock:
+            self.buffer.append(values)
+            full = len(self.buffer) >= self.every
+        if full:
+            self.event.set()
+
+    def _run(self):
+        while not self.closed:
+            self.event.wait(self.interval)
+            self.event.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+        if len(buffer) == 0:
+            return
+        with self.io_lock:
+            if self.binary:
+                self._flush_binary(buffer)
+            else:
+                self.f.write(''.join(f'{line}\n' for line in buffer))
+                self.f.flush()
+
+    def _flush_binary(self, buffer):
+        comments = [line for line in buffer if type(line) == str]
+        if comments:
+            self.comments.write(''.join(f'{line}\n' for line in comments))
+            self.comments.flush()
+        rows = [row for row in buffer if type(row) != str]
+        if rows:
+            rows = np.asarray(rows, dtype='<f8')
+            rows = rows.reshape(rows.shape[0], -1)
+            if self.cols is None or self.rows == 0:
+                self.cols = rows.shape[1]
+            assert rows.shape[1] == self.cols
+            self.f.seek(0, 2)
+            self.f.write(rows.tobytes())
+            self.rows += rows.shape[0]
+            self.f.seek(0)
+            self.f.write(npy_header(self.rows, self.cols))
+            self.f.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.event.set()
+        self.thread.join()
+        self.flush()
+        self.f.close()
+        if self.binary:
+            self.comments.close()
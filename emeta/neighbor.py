@@ -0,0 +1,164 @@
+# +
+import itertools
+import torch
+
+
+class NeighborList:
+    """
+    Cell-list neighbor search with a Verlet skin.
+    Pairs are found within cutoff+skin and the list is
+    rebuilt only if an atom moves more than skin/2 or
+    the cell changes. Pairs are returned as (i, j, shifts)
+    such that r_ij = pos[j] - pos[i] + shifts @ cell;
+    these are constants, thus distances computed from
+    them stay differentiable w.r.t. pos and cell.
+    """
+
+    def __init__(self, cutoff, skin=0.5):
+        self.cutoff = cutoff
+        self.skin = skin
+        self.builds = 0
+        self._pos = None
+        self._cell = None
+
+    def __call__(self, pos, cell, pbc):
+        if self.stale(pos, cell):
+            self.build(pos, cell, pbc)
+        return self.i, self.j, self.shifts
+
+    def stale(self, pos, cell):
+        if self._pos is None or self._pos.shape != pos.shape:
+            return True
+        if not torch.equal(self._cell, cell.detach()):
+            return True
+        disp = (pos.detach()-self._pos).norm(dim=1).max()
+        return 2*disp > self.skin
+
+    def build(self, pos, cell, pbc):
+        pos = pos.detach()
+        cell = cell.detach()
+        pbc = torch.as_tensor(pbc, dtype=torch.bool)
+        rc = self.cutoff + self.skin
+
+        # wrap along periodic directions, keeping track of the images
+        rcell = cell.inverse()
+        scaled = pos @ rcell
+        image = torch.where(pbc, scaled.floor(), torch.zeros_like(scaled))
+        scaled = scaled - image
+
+        # bins: at least rc wide, perpendicular to cell planes
+        height = 1./rcell.norm(dim=0)
+        lo = torch.where(pbc, torch.zeros(3, dtype=scaled.dtype),
+                         scaled.min(dim=0).values)
+        span = torch.where(pbc, torch.ones(3, dtype=scaled.dtype),
+                           (scaled.max(dim=0).values-lo).clamp(min=1e-12))
+        nbins = (span*height/rc).floor().clamp(min=1).long()
+        reach = torch.where(pbc, (rc*nbins/(span*height)).ceil().long(),
+                            torch.ones(3, dtype=torch.long))
+        bins = ((scaled-lo)/span*nbins).floor().long()
+        bins = torch.minimum(bins.clamp(min=0), nbins-1)
+
+        # table of atoms in each bin, padded with -1
+        n = nbins.tolist()
+        strides = torch.tensor([n[1]*n[2], n[2], 1])
+        lin = (bins*strides).sum(dim=1)
+        order = lin.argsort()
+        counts = torch.bincount(lin, minlength=int(nbins.prod()))
+        start = counts.cumsum(0) - counts
+        rank = torch.arange(lin.size(0)) - start[lin[order]]
+        table = torch.full((counts.size(0), int(counts.max())), -1,
+                           dtype=torch.long)
+        table[lin[order], rank] = order
+
+        # scan neighboring bins, one offset at a time to bound memory
+        atoms = torch.arange(pos.size(0))
+        I, J, S = [], [], []
+        for offset in itertools.product(*(range(-k, k+1) for k in reach.tolist())):
+            nb = bins + torch.tensor(offset)
+            shift = torch.div(nb, nbins, rounding_mode='floor')
+            valid = (pbc | (shift == 0)).all(dim=1)
+            shift = torch.where(pbc, shift, torch.zeros_like(shift))
+            nb = nb - shift*nbins
+            # out of range along non-periodic directions: any bin, masked by valid
+            nb = torch.minimum(nb.clamp(min=0), nbins-1)
+            cand = table[(nb*strides).sum(dim=1)]
+            i = atoms[:, None].expand_as(cand)
+            ok = (cand >= 0) & valid[:, None]
+            i, j = i[ok], cand[ok]
+            s = (shift[:, None].expand(-1, cand.size(1), -1)[ok]
+                 - image[j].long() + image[i].long()).to(cell.dtype)
+            r = pos[j] - pos[i] + s @ cell
+            keep = (r.norm(dim=1) < rc) & ((i != j) | (s != 0).any(dim=1))
+            I.append(i[keep])
+            J.append(j[keep])
+            S.append(s[keep])
+
+        self.i = torch.cat(I)
+        self.j = torch.cat(J)
+        self.shifts = torch.cat(S)
+        self._pos = pos.clone()
+        self._cell = cell.clone()
+        self.builds += 1
+
+
+def brute_force(pos, cell, pbc, rc):
+    """all (i, j, shifts) with |r_ij| < rc over enough images"""
+    rcell = cell.inverse()
+    reach = [int((rc*rcell[:, k].norm()).ceil())+1 if p else 0
+             for k, p in enumerate(pbc)]
+    pairs = set()
+    for s in itertools.product(*(range(-k, k+1) for k in reach)):
+        shift = torch.tensor(s, dtype=cell.dtype)
+        r = pos[None] - pos[:, None] + shift @ cell
+        d = r.norm(dim=-1)
+        for i, j in (d < rc).nonzero().tolist():
+            if i != j or any(s):
+                pairs.add((i, j, s))
+    return pairs
+
+
+def listed(nl, pos, cell, pbc, rc):
+    """pairs of nl (updated for pos) within rc"""
+    i, j, s = nl(pos, cell, pbc)
+    r = pos[j] - pos[i] + s @ cell
+    keep = r.norm(dim=1) < rc
+    return {(a, b, tuple(int(x) for x in c)) for a, b, c in
+            zip(i[keep].tolist(), j[keep].tolist(), s[keep].round().tolist())}
+
+
+def test_NeighborList():
+    torch.manual_seed(0)
+    cutoff, skin = 2., 0.5
+    cubic = 5*torch.eye(3, dtype=torch.float64)
+    triclinic = torch.tensor([[5., 0., 0.], [2., 4.5, 0.], [1., 1.5, 4.]],
+                             dtype=torch.float64)
+    small = torch.tensor([[2.5, 0., 0.], [0.5, 2.2, 0.], [0., 0.3, 2.4]],
+                         dtype=torch.float64)
+    cases = [('cubic', cubic, [True]*3), ('triclinic', triclinic, [True]*3),
+             ('small', small, [True]*3), ('slab', triclinic, [True, True, False]),
+             ('free', cubic, [False]*3), ('free triclinic', triclinic, [False]*3)]
+    for name, cell, pbc in cases:
+        # some atoms outside the cell to check wrapping
+        scaled = torch.rand(20, 3, dtype=torch.float64)*1.4 - 0.2
+        pos = scaled @ cell
+        nl = NeighborList(cutoff, skin)
+        ok = listed(nl, pos, cell, pbc, cutoff+skin) == brute_force(
+            pos, cell, pbc, cutoff+skin)
+        # small moves: no rebuild, the list still covers the cutoff
+        move = torch.randn_like(pos)
+        move = 0.2*skin*move/move.norm(dim=1, keepdim=True)
+        pos = pos + move
+        ok &= listed(nl, pos, cell, pbc, cutoff) == brute_force(
+            pos, cell, pbc, cutoff)
+        ok &= nl.builds == 1
+        # a move beyond skin/2: rebuild
+        pos = pos.clone()
+        pos[0] += 0.6*skin
+        ok &= listed(nl, pos, cell, pbc, cutoff+skin) == brute_force(
+            pos, cell, pbc, cutoff+skin)
+        ok &= nl.builds == 2
+        print(f'NeighborList vs brute force ({name}): {ok}')
+
+
+if __name__ == '__main__':
+    test_NeighborList()
@@ -0,0 +1,143 @@
+# +
+"""
+Per-node profiling of variable graphs:
+
+    with Profiler() as prof:
+        bias().backward()
+    print(prof.table())
+    prof.chrome('trace.json')
+
+For every node: calls, cache hits and misses (evaluations),
+inclusive and exclusive forward time and backward time.
+The backward time of a node is measured from the arrival
+of the grad of its value (a tensor hook) to the arrival of
+the next grad, thus it includes the autograd functions
+between the node and its dependencies. When no profiler
+is active, the cost is a single check per call.
+Events for Chrome tracing (chrome://tracing, perfetto)
+are kept only if trace=True.
+"""
+import json
+import time
+import torch
+from .variable import Variable
+
+
+class Stats:
+
+    __slots__ = ('calls', 'hits', 'misses', 'inclusive', 'exclusive', 'backward')
+
+    def __init__(self):
+        self.calls = 0
+        self.hits = 0
+        self.misses = 0
+        self.inclusive = 0.
+        self.exclusive = 0.
+        self.backward = 0.
+
+
+class Profiler:
+
+    def __init__(self, backward=True, trace=False):
+        self.backward = backward
+        self.trace = trace
+        self.stats = {}
+        self.events = []
+        self.stack = []  # inclusive time of the children of active calls
+        self._last = None  # (node, time) of the latest grad arrival
+        self._previous = None
+        self.origin = time.perf_counter()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._previous = Variable.profiler
+        Variable.profiler = self
+
+    def stop(self):
+        Variable.profiler = self._previous
+        self._previous = None
+
+    def reset(self):
+        self.stats = {}
+        self.events = []
+
+    def call(self, node, context):
+        stats = self.stats.get(node)
+        if stats is None:
+            stats = self.stats[node] = Stats()
+        evaluations = node.evaluations
+        self.stack.append(0.)
+        t0 = time.perf_counter()
+        try:
+            value = node._call(context)
+        finally:
+            t = time.perf_counter() - t0
+            children = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += t
+        stats.calls += 1
+        stats.inclusive += t
+        stats.exclusive += t - children
+        miss = node.evaluations > evaluations
+        if miss:
+            stats.misses += 1
+            if (self.backward and isinstance(value, torch.Tensor) and
+                    value.requires_grad):
+                value.register_hook(self.hook(node))
+        else:
+            stats.hits += 1
+        if self.trace:
+            self.events.append({'name': name(node), 'cat': 'forward', 'ph': 'X',
+                                'ts': (t0-self.origin)*1e6, 'dur': t*1e6,
+                                'pid': 0, 'tid': 0, 'args': {'miss': miss}})
+        return value
+
+    def hook(self, node):
+        def hook(grad):
+            t = time.perf_counter()
+            if self._last is None:
+                # the first grad of this backward pass
+                torch.autograd.Variable._execution_engine.queue_callback(
+                    self._close)
+            else:
+                self._segment(t)
+            self._last = (node, t)
+        return hook
+
+    def _segment(self, t):
+        node, t0 = self._last
+        self.stats[node].backward += t - t0
+        if self.trace:
+            self.events.append({'name': name(node), 'cat': 'backward', 'ph': 'X',
+                                'ts': (t0-self.origin)*1e6, 'dur': (t-t0)*1e6,
+                                'pid': 0, 'tid': 1})
+
+    def _close(self):
+        self._segment(time.perf_counter())
+        self._last = None
+
+    def table(self, sort='exclusive', limit=None):
+        rows = sorted(self.stats.items(), key=lambda kv: getattr(kv[1], sort),
+                      reverse=True)[:limit]
+        lines = [f'{"node":40} {"calls":>8} {"hits":>8} {"misses":>8} '
+                 f'{"incl(s)":>10} {"excl(s)":>10} {"back(s)":>10}']
+        for node, s in rows:
+            lines.append(f'{name(node):40} {s.calls:8d} {s.hits:8d} '
+                         f'{s.misses:8d} {s.inclusive:10.4g} '
+                         f'{s.exclusive:10.4g} {s.backward:10.4g}')
+        return '\n'.join(lines)
+
+    def chrome(self, file):
+        with open(file, 'w') as f:
+            json.dump({'traceEvents': self.events}, f)
+
+
+def name(node, width=40):
+    n = repr(node)
+    return n if len(n) <= width else n[:width-3] + '...'
@@ -14,9 +14,15 @@ def bordered(m, c, r, d):
 
 class SPD:
 
-    def __init__(self, matrix=None, epsilon=1e-1):
-        self.data = matrix or torch.eye(1)
+    def __init__(self, matrix=None, epsilon=1e-1, incremental=True, check=None,
+                 dtype=torch.float64):
+        # the factorization is kept in dtype, whatever the inputs
+        self.dtype = dtype
+        self.data = torch.eye(1) if matrix is None else matrix
         self.epsilon = epsilon
+        self.incremental = incremental
+        self.check = check  # full accuracy check every "check" appends
+        self.appends = 0
 
     @property
     def data(self):
@@ -24,7 +30,7 @@ class SPD:
 
     @data.setter
     def data(self, data):
-        self._data = data
+        self._data = data.to(self.dtype)
         self._cholesky = None
         self._inverse = None
 
@@ -39,12 +45,16 @@ class SPD:
         return self._inverse
 
     def append_(self, column, diagonal, epsilon=None):
-        a = column.view(-1, 1)
-        i = torch.as_tensor(diagonal).view(1, 1)
+        a = column.view(-1, 1).to(self.dtype)
+        i = torch.as_tensor(diagonal, dtype=self.dtype).view(1, 1)
         alpha = self.inverse()@a
         v = (i-a.T@alpha)
         if v < (epsilon if epsilon else self.epsilon):
             return False
+        self.appends += 1
+        full = self.check and self.appends % self.check == 0
+        if self.incremental and not full and self._extend_(a, i, alpha, v):
+            return True
         #
         data = bordered(self.data, a, a.T, i)
         try:
@@ -54,7 +64,7 @@ class SPD:
             return False
         if data.isnan().any() or chol.isnan().any() or inv.isnan().any():
             raise RuntimeError('nan in SPD!')
-        ierr = (data@inv-torch.eye(data.size(0))).abs().max()
+        ierr = (data@inv-torch.eye(data.size(0), dtype=self.dtype)).abs().max()
         if ierr > 1e-3:
             warnings.warn('spd.append_ rejected bc inv err > 1e-3')
             return False
@@ -64,8 +74,159 @@ class SPD:
         self._inverse = inv
         return True
 
+    def _extend_(self, a, i, alpha, v):
+        """O(n^2) bordered update of the cholesky factor and the inverse"""
+        chol = self.cholesky()
+        l = torch.linalg.solve_triangular(chol, a, upper=False)
+        s = (i-l.T@l).sqrt()
+        u = alpha/v
+        inv = bordered(self.inverse()+alpha@u.T, -u, -u.T, 1./v)
+        chol = bordered(chol, torch.zeros_like(a), l.T, s)
+        data = bordered(self.data, a, a.T, i)
+        # cheap check: the last row of data@inv should be a unit vector
+        row = data[-1:]@inv
+        row[0, -1] -= 1.
+        if not (s > 0 and row.abs().max() < 1e-3):
+            return False
+        self.data = data
+        self._cholesky = chol
+        self._inverse = inv
+        return True
+
+    def extend_(self, columns, block, epsilon=None):
+        """
+        Block version of append_ for candidate columns (n, k) with
+        the (k, k) block of their own: candidates are accepted in
+        order if their variance, conditioned on the matrix and the
+        previously accepted candidates, exceeds epsilon. The factor
+        and the inverse are extended once (refactorized in full if not
+        incremental or if a check is due, as in append_), otherwise
+        they fall back to append_. Returns accepted indices.
+        """
+        eps = epsilon if epsilon else self.epsilon
+        columns = columns.to(self.dtype)
+        block = block.to(self.dtype)
+        alpha = self.inverse()@columns
+        schur = block - columns.T@alpha
+        accepted = []
+        chol = schur.new_zeros(0, 0)
+        for i in range(schur.size(0)):
+            if accepted:
+                l = torch.linalg.solve_triangular(
+                    chol, schur[accepted, i:i+1], upper=False)
+            else:
+                l = schur.new_zeros(0, 1)
+            v = schur[i, i] - (l*l).sum()
+            if v >= eps:
+                accepted.append(i)
+                chol = bordered(chol, torch.zeros_like(l), l.T, v.sqrt().view(1, 1))
+        idx = torch.tensor(accepted, dtype=torch.long)
+        if len(accepted) == 0:
+            return idx
+        c = columns[:, idx]
+        a = alpha[:, idx]
+        n = len(accepted)
+        data = bordered(self.data, c, c.T, block[idx][:, idx])
+        due = self.check and (self.appends+n)//self.check > self.appends//self.check
+        if self.incremental and not due:
+            sinv = chol.cholesky_inverse()
+            b = torch.linalg.solve_triangular(self.cholesky(), c, upper=False)
+            u = a@sinv
+            inv = bordered(self.inverse()+u@a.T, -u, -u.T, sinv)
+            chol = bordered(self.cholesky(), torch.zeros_like(c), b.T, chol)
+            # cheap check: the new rows of data@inv should be unit vectors
+            rows = data[-n:]@inv
+            rows[:, -n:] -= torch.eye(n, dtype=self.dtype)
+            ok = rows.abs().max() < 1e-3
+        else:
+            # full factorization and check, as in append_
+            try:
+                chol = data.cholesky()
+                inv = chol.cholesky_inverse()
+            except:
+                return self._append_each(columns, block, eps)
+            if data.isnan().any() or chol.isnan().any() or inv.isnan().any():
+                raise RuntimeError('nan in SPD!')
+            ierr = (data@inv-torch.eye(data.size(0), dtype=self.dtype)).abs().max()
+            ok = ierr < 1e-3
+        if not ok:
+            return self._append_each(columns, block, eps)
+        self.appends += n
+        self.data = data
+        self._cholesky = chol
+        self._inverse = inv
+        return idx
+
+    def _append_each(self, columns, block, eps):
+        """fallback of extend_: one by one appends"""
+        accepted = []
+        for i in range(columns.size(1)):
+            prev = torch.tensor(accepted, dtype=torch.long)
+            column = torch.cat([columns[:, i], block[prev, i]])
+            if self.append_(column, block[i, i], eps):
+                accepted.append(i)
+        return torch.tensor(accepted, dtype=torch.long)
+
+    def state_dict(self):
+        return {'data': self.data, 'cholesky': self.cholesky(),
+                'inverse': self.inverse()}
+
+    def load_state_dict(self, state):
+        self.data = state['data']
+        self._cholesky = state['cholesky'].to(self.dtype)
+        self._inverse = state['inverse'].to(self.dtype)
+
     def log_prob(self, y):
-        _y = torch.as_tensor(y).view(-1, 1)
+        _y = torch.as_tensor(y, dtype=self.dtype).view(-1, 1)
         f = -0.5*(_y.T@self.inverse()@_y + 2*self.cholesky().diag().log().sum() +
                   _y.size(0)*torch.log(torch.tensor(2*pi)))
         return f
+
+
+def gaussian_matrix(x):
+    return (-torch.cdist(x, x).pow(2)/2).exp()
+
+
+def points():
+    """random points with a near-duplicate of point 1 at 3"""
+    torch.manual_seed(0)
+    x = 2*torch.randn(12, 2, dtype=torch.float64)
+    x[3] = x[1] + 1e-6
+    return x
+
+
+def matches(spd, k):
+    """the factor and the inverse of spd match a fresh factorization of k"""
+    chol = torch.linalg.cholesky(k)
+    return (torch.allclose(spd.data, k) and
+            torch.allclose(spd.cholesky(), chol, atol=1e-8) and
+            torch.allclose(spd.inverse(), torch.cholesky_inverse(chol), atol=1e-6))
+
+
+def test_append():
+    k = gaussian_matrix(points())
+    for incremental, check in [(True, None), (True, 3), (False, None)]:
+        spd = SPD(k[:1, :1], epsilon=1e-3, incremental=incremental, check=check)
+        accepted = [0]
+        for i in range(1, k.size(0)):
+            if spd.append_(k[accepted, i], k[i, i]):
+                accepted.append(i)
+        ok = 1 in accepted and 3 not in accepted
+        ok &= matches(spd, k[accepted][:, accepted])
+        print(f'append_ (incremental={incremental}, check={check}): {ok}')
+
+
+def test_extend():
+    k = gaussian_matrix(points())
+    for incremental, check in [(True, None), (True, 3), (False, None)]:
+        spd = SPD(k[:1, :1], epsilon=1e-3, incremental=incremental, check=check)
+        idx = spd.extend_(k[:1, 1:], k[1:, 1:]) + 1
+        accepted = [0] + idx.tolist()
+        ok = 1 in accepted and 3 not in accepted
+        ok &= matches(spd, k[accepted][:, accepted])
+        print(f'extend_ (incremental={incremental}, check={check}): {ok}')
+
+
+if __name__ == '__main__':
+    test_append()
+    test_extend()
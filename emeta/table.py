@@ -0,0 +1,98 @@
+# +
+import itertools
+import torch
+from .util import get_dtype
+
+
+class Table:
+    """
+    Kernel sums tabulated on a regular grid of (bins+1)
+    nodes per dimension between lower and upper.
+    Deposits are added incrementally and evaluation is
+    interpolated (order=1: multilinear, forces from the
+    tabulated gradient; order=3: Catmull-Rom), thus the
+    cost per step does not grow with the number of deposits.
+    The table is kept in dtype (default: util.get_dtype() or
+    the default dtype of torch); inputs are not cast.
+    """
+
+    def __init__(self, lower, upper, bins, order=1, dtype=None):
+        assert order in (1, 3)
+        self.dtype = dtype or get_dtype() or torch.get_default_dtype()
+        self.lower = torch.as_tensor(lower, dtype=self.dtype).view(-1)
+        self.upper = torch.as_tensor(upper, dtype=self.dtype).view(-1)
+        self.dim = self.lower.size(0)
+        self.bins = torch.as_tensor(bins).view(-1).expand(self.dim).long()
+        self.delta = (self.upper-self.lower)/self.bins
+        self.order = order
+        axes = [torch.linspace(l, u, b+1, dtype=self.dtype) for l, u, b in
+                zip(self.lower.tolist(), self.upper.tolist(), self.bins.tolist())]
+        self.points = torch.stack(torch.meshgrid(*axes, indexing='ij'),
+                                  dim=-1).view(-1, self.dim)
+        n = (self.bins+1).tolist()
+        self.strides = torch.tensor([int(torch.tensor(n[i+1:]).prod())
+                                     for i in range(self.dim)])
+        self.values = torch.zeros(self.points.size(0), dtype=self.dtype)
+        self.grads = torch.zeros(self.points.size(0), self.dim, dtype=self.dtype)
+
+    def add(self, kern, x, weights=None):
+        points = self.points.clone().requires_grad_(True)
+        k = kern(points, x)
+        if weights is not None:
+            k = k@weights.to(k.dtype)
+        s = k.sum(dim=1)
+        g, = torch.autograd.grad(s.sum(), points)
+        self.values += s.detach().to(self.values.dtype)
+        self.grads += g.to(self.grads.dtype)
+
+    def state_dict(self):
+        return {'values': self.values, 'grads': self.grads}
+
+    def load_state_dict(self, state):
+        self.values = state['values']
+        self.grads = state['grads']
+
+    def covers(self, x):
+        return bool(((x >= self.lower) & (x <= self.upper)).all())
+
+    def __call__(self, x):
+        u = (x-self.lower)/self.delta
+        i = torch.minimum(u.detach().floor().long().clamp(min=0), self.bins-1)
+        t = u - i
+        if self.order == 1:
+            return _Linear.apply(x, t, i, self)
+        return self.cubic(t, i)
+
+    def corners(self, t, i):
+        c = torch.tensor(list(itertools.product([0, 1], repeat=self.dim)))
+        w = torch.where(c.bool(), t[:, None], 1-t[:, None]).prod(dim=-1)
+        lin = ((i[:, None]+c)*self.strides).sum(dim=-1)
+        return w, lin
+
+    def cubic(self, t, i):
+        t = t[..., None]
+        t2, t3 = t*t, t*t*t
+        # Catmull-Rom basis for nodes i-1, i, i+1, i+2
+        basis = torch.cat([-t3+2*t2-t, 3*t3-5*t2+2,
+                           -3*t3+4*t2+t, t3-t2], dim=-1)/2
+        c = torch.tensor(list(itertools.product(range(4), repeat=self.dim)))
+        w = basis[:, torch.arange(self.dim), c].prod(dim=-1)
+        idx = torch.minimum((i[:, None]+c-1).clamp(min=0), self.bins)
+        lin = (idx*self.strides).sum(dim=-1)
+        return (w*self.values[lin]).sum(dim=-1)
+
+
+class _Linear(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, x, t, i, table):
+        w, lin = table.corners(t.detach(), i)
+        ctx.save_for_backward(w, lin)
+        ctx.table = table
+        return (w*table.values[lin]).sum(dim=-1)
+
+    @staticmethod
+    def backward(ctx, grad):
+        w, lin = ctx.saved_tensors
+        g = (w[..., None]*ctx.table.grads[lin]).sum(dim=1)
+        return grad[:, None]*g, None, None, None
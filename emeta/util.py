@@ -2,7 +2,62 @@
 import torch
 
 
+_dtype = None
+
+
+def set_dtype(dtype):
+    """
+    The dtype of atomic variables and biases (e.g. torch.float32),
+    None keeps the dtype of the inputs (float64 for ase atoms).
+    Positions, cell and forces stay float64 (see atomic.Data).
+    """
+    global _dtype
+    _dtype = dtype
+
+
+def get_dtype():
+    return _dtype
+
+
 def kldiv(p, q):
     """returns p*log(p/q)"""
     return p*torch.where(q > torch.finfo().eps,
                          (p/q).log(), torch.zeros(1))
+
+
+def bin_index(bins):
+    """linearized int64 index of integer bins (rows of a 2d tensor)"""
+    dim = bins.size(-1)
+    bits = 63//dim
+    shifts = torch.arange(dim)*bits
+    return ((bins + (1 << (bits-1))) << shifts).sum(dim=-1)
+
+
+class Buffer:
+    """growable tensor with amortized appends along dim 0"""
+
+    def __init__(self, capacity=16):
+        self.capacity = capacity
+        self.size = 0
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            return None
+        return self._data[:self.size]
+
+    def __len__(self):
+        return self.size
+
+    def append(self, x):
+        n = self.size + x.size(0)
+        if self._data is None:
+            self._data = x.new_zeros(max(self.capacity, n), *x.shape[1:])
+        elif n > self._data.size(0):
+            data = self._data.new_zeros(max(2*self._data.size(0), n),
+                                        *self._data.shape[1:])
+            data[:self.size] = self._data[:self.size]
+            self._data = data
+        self._data[self.size:n] = x
+        self.size = n
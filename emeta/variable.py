@@ -1,8 +1,53 @@
 # +
+import itertools
+import weakref
 import torch
 
 
-class Variable:
+_clock = itertools.count(1)
+
+
+def tick():
+    """a new version number, larger than all previous ones"""
+    return next(_clock)
+
+
+def key(arg):
+    if arg is None or isinstance(arg, (bool, int, float, str)):
+        return (type(arg), arg)
+    if isinstance(arg, (tuple, list)):
+        return (type(arg), tuple(key(a) for a in arg))
+    if isinstance(arg, dict):
+        return (dict, tuple((k, key(v)) for k, v in sorted(arg.items())))
+    # nodes keep their arguments alive, thus ids are not reused
+    return id(arg)
+
+
+class Shared(type):
+    """
+    Hash-consing: for classes with shared=True, a call
+    with the same arguments returns the existing node,
+    thus common subexpressions are evaluated once.
+    """
+
+    nodes = weakref.WeakValueDictionary()
+
+    def __call__(cls, *args, **kwargs):
+        if not cls.shared:
+            return super().__call__(*args, **kwargs)
+        k = (cls, key(args), key(kwargs))
+        try:
+            return Shared.nodes[k]
+        except KeyError:
+            node = super().__call__(*args, **kwargs)
+            Shared.nodes[k] = node
+            return node
+
+
+class Variable(metaclass=Shared):
+
+    shared = False
+    profiler = None  # see profile.Profiler
 
     def __init__(self, *init_args, **init_kwargs):
         self.init_args = init_args
@@ -19,20 +64,50 @@ class Variable:
                     arg.requires_update)
         self.dependants = set()
         self.value = None
+        self.version = 0
+        self._stamp = None
+        self._context = None
+        self._sources = None
+        self.evaluations = 0
 
     def evaluate(self, context):
         raise RuntimeError('implement in a subclass')
 
     def __call__(self, context=None):
+        if Variable.profiler is not None:
+            return Variable.profiler.call(self, context)
+        return self._call(context)
+
+    def _call(self, context=None):
         if context:
             if self in context:
                 return context[self]
-            else:
+            # only versioned contexts (e.g. atomic.Data) are cached
+            version = getattr(context, 'version', None)
+            if version is None:
+                self.evaluations += 1
                 return self.evaluate(context)
-        if self.value is None:
+        else:
+            # the value from the latest context, if any, is current
+            version = None
+        stamp = self.sources_version()
+        if (self.value is None or self._stamp != stamp or
+                version not in (None, self._context)):
+            self.evaluations += 1
             self.value = self.evaluate(context)
+            self._stamp = stamp
+            self._context = version
         return self.value
 
+    def sources_version(self):
+        """the latest version of the params and stateful nodes upstream"""
+        if self._sources is None:
+            self._sources = tuple(self.params | self.requires_update)
+        return max((src.version for src in self._sources), default=0)
+
+    def touch(self):
+        self.version = tick()
+
     def _forward(self):
         self.value = None
         for dep in self.dependants:
@@ -47,6 +122,9 @@ class Variable:
         for var in self.requires_update:
             var.update()
 
+    def compile(self):
+        return Tape(self)
+
     def __add__(self, other):
         return binary_op(self, other, Sum)
 
@@ -111,6 +189,42 @@ def evaluate(var, context):
         return var
 
 
+class Tape:
+    """
+    The graph of a variable, topologically sorted once.
+    Calling a tape evaluates every node at most once, in
+    order, and keeps the values in the context where the
+    dependants find them (values already in the context
+    are treated as given).
+    """
+
+    def __init__(self, var):
+        self.var = var
+        self.nodes = []
+        visited = set()
+        stack = [(var, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                self.nodes.append(node)
+            elif node not in visited:
+                visited.add(node)
+                stack.append((node, True))
+                stack.extend((dep, False) for dep in node.dependencies
+                             if dep not in visited)
+
+    def __call__(self, context=None):
+        if context is None:
+            context = {}
+        for node in self.nodes:
+            if node not in context:
+                context[node] = node(context)
+        return context[self.var]
+
+    def __repr__(self):
+        return f'Tape({self.var}, nodes={len(self.nodes)})'
+
+
 class GetAttr:
 
     def __init__(self, _self, attr):
@@ -123,6 +237,8 @@ class GetAttr:
 
 class Attr(Variable):
 
+    shared = True
+
     def __init__(self, var, attr, *args, **kwargs):
         super().__init__(var, attr, *args, **kwargs)
         self.var = var
@@ -154,6 +270,8 @@ def binary_op(self, other, Cls):
 
 class Binary(Variable):
 
+    shared = True
+
     def __init__(self, *args):
         super().__init__(*args)
         self.args = args
@@ -232,6 +350,8 @@ class Pow(Binary):
 
 class Neg(Variable):
 
+    shared = True
+
     def __init__(self, arg):
         super().__init__(arg)
         self.arg = arg
@@ -245,6 +365,8 @@ class Neg(Variable):
 
 class Flat(Variable):
 
+    shared = True
+
     def __init__(self, *args):
         super().__init__(*args)
 
@@ -269,6 +391,7 @@ class Par(Variable):
         self.name = name
         Par.instances[name] = self
         self.params.add(self)
+        self.walkers = None  # size of the leading walker dim, if any
 
     def evaluate(self, context):
         return self.data
@@ -279,14 +402,15 @@ class Par(Variable):
     def set(self, data, rg=True):
         self.data = torch.as_tensor(data)
         self.data.requires_grad = rg
-        self._forward()
+        self.walkers = None
+        self.touch()
 
     def add(self, data):
         self.data.data += data
         if self.data.grad is not None:
             self.data.grad.detach_()
             self.data.grad.zero_()
-        self._forward()
+        self.touch()
 
     @property
     def force(self):
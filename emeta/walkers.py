@@ -0,0 +1,66 @@
+# +
+"""
+Multiple walkers: independent processes (e.g. several MD runs
+on one node) sharing the deposits of their biases through a
+directory. Each walker appends its own deposits to its own
+file (a single writer per file, thus no locks are needed) and
+reads the new complete records of the other walkers every
+"every" updates.
+
+    walkers = Walkers('exchange', rank)
+    bias = GridKDE(cv, kern, walkers=walkers)
+"""
+import os
+import numpy as np
+import torch
+
+
+class Walkers:
+
+    def __init__(self, directory, rank, every=1):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.rank = rank
+        self.every = every
+        self.name = f'{rank}.walker'
+        self.file = open(os.path.join(directory, self.name), 'ab')
+        self.offsets = {}
+        self.updates = 0
+
+    def push(self, x):
+        x = x.detach().to(torch.float64).view(-1).numpy()
+        self.file.write(x.tobytes())
+        self.file.flush()
+
+    def due(self):
+        self.updates += 1
+        return self.updates % self.every == 0
+
+    def pull(self, dim):
+        """new deposits of the other walkers as a (n, dim) tensor"""
+        record = 8*dim
+        new = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.walker') or entry.name == self.name:
+                continue
+            offset = self.offsets.get(entry.name, 0)
+            n = (entry.stat().st_size - offset)//record
+            if n > 0:
+                with open(entry.path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read(n*record)
+                new.append(np.frombuffer(data, dtype=np.float64).reshape(n, dim))
+                self.offsets[entry.name] = offset + n*record
+        if len(new) == 0:
+            return torch.empty(0, dim, dtype=torch.float64)
+        return torch.from_numpy(np.concatenate(new))
+
+    def state_dict(self):
+        return {'offsets': self.offsets, 'updates': self.updates}
+
+    def load_state_dict(self, state):
+        self.offsets = dict(state['offsets'])
+        self.updates = state['updates']
+
+    def close(self):
+        self.file.close()